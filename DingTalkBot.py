@@ -1,17 +1,295 @@
 import base64
 import hashlib
 import hmac
+import json
 import logging
+import queue
+import threading
 import time
 import urllib
+from concurrent.futures import Future
 
-import requests
+from http_client import get_transport
+from metrics import HTTP_RETRIES, time_request
+
+
+# 钉钉自定义机器人单条消息的请求体上限（字节）
+MAX_PAYLOAD_BYTES = 20000
+# 拆分长消息时依次尝试的分隔位置：报告之间、段落之间、行之间
+SPLIT_SEPARATORS = ("  \n  \n  ---  \n  \n  ", "\n\n---\n\n", "  \n  \n  ", "\n\n", "  \n  ", "\n")
+
+
+def encode_payload(data):
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def payload_size(data):
+    """消息按实际发送的编码方式序列化后的字节数"""
+    return len(encode_payload(data))
+
+
+def _encoded_len(text):
+    # 字符串在 JSON 中的长度，不含两端引号
+    return len(json.dumps(text, ensure_ascii=False).encode("utf-8")) - 2
+
+
+def split_text(text, limit, separators=SPLIT_SEPARATORS):
+    """
+    将文本拆分为编码后均不超过 limit 字节的若干段，优先在靠前的分隔符处拆分，
+    单段仍然过长时再按更细的分隔符拆分，最后按字符截断
+    """
+    if _encoded_len(text) <= limit:
+        return [text]
+    if not separators:
+        parts, current, current_len = [], "", 0
+        for char in text:
+            char_len = _encoded_len(char)
+            if current and current_len + char_len > limit:
+                parts.append(current)
+                current, current_len = "", 0
+            current += char
+            current_len += char_len
+        if current:
+            parts.append(current)
+        return parts
+    separator = separators[0]
+    pieces = text.split(separator)
+    if len(pieces) == 1:
+        return split_text(text, limit, separators[1:])
+    parts = []
+    current = None
+    for piece in pieces:
+        for chunk in split_text(piece, limit, separators[1:]):
+            candidate = chunk if current is None else current + separator + chunk
+            if _encoded_len(candidate) <= limit:
+                current = candidate
+            else:
+                if current is not None:
+                    parts.append(current)
+                current = chunk
+    if current is not None:
+        parts.append(current)
+    return parts
+
+
+def build_messages(data, max_bytes=MAX_PAYLOAD_BYTES):
+    """
+    发送前检查消息大小，超过上限时拆分为带编号的多条消息。
+    actionCard 的按钮只保留在最后一条中
+    """
+    if payload_size(data) <= max_bytes:
+        return [data]
+    msgtype = data.get("msgtype")
+    field = "content" if msgtype == "text" else "text"
+    body = data[msgtype]
+    text = body[field]
+
+    # 预留编号所占的长度，编号位数按最多 999 条估算
+    empty = {**data, msgtype: {**body, field: "", **({"title": f"{body['title']} (999/999)"} if "title" in body else {})}}
+    limit = max_bytes - payload_size(empty) - _encoded_len("(999/999)  \n  ")
+    if limit <= 0:
+        raise ValueError("消息标题或按钮过长，无法拆分")
+    chunks = split_text(text, limit)
+    total = len(chunks)
+    messages = []
+    for index, chunk in enumerate(chunks, 1):
+        part = dict(body)
+        if msgtype == "text":
+            part[field] = f"({index}/{total}) {chunk}"
+        else:
+            part[field] = f"({index}/{total})  \n  {chunk}"
+        if "title" in part:
+            part["title"] = f"{body['title']} ({index}/{total})"
+        if msgtype == "actionCard" and index < total:
+            part["btns"] = []
+        messages.append({**data, msgtype: part})
+    logging.info(f"钉钉通知长度 {payload_size(data)} 字节超过上限，拆分为 {total} 条发送")
+    return messages
+
+
+def _all_of(futures):
+    """所有 Future 完成后完成，结果为是否全部发送成功"""
+    combined = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result(all(future.result() for future in futures))
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return combined
+
+
+class TokenBucket(object):
+    """令牌桶限流，capacity 为突发上限，rate 为每秒补充的令牌数"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """获取一个令牌，没有可用令牌时阻塞等待；需要等到 deadline（time.monotonic()）之后时不等待，返回 False"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait >= deadline:
+                return False
+            time.sleep(wait)
+
+
+class DingTalkDispatcher(object):
+    """
+    单个机器人的发送队列，由后台线程按钉钉的限流（默认每分钟 20 条）发送。
+    排队期间同一类型、同一标题和按钮的消息会合并为一条。
+    """
+
+    _dispatchers = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, rate_per_minute=20, max_bytes=MAX_PAYLOAD_BYTES):
+        self.bucket = TokenBucket(rate_per_minute / 60, rate_per_minute)
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.__run, name="dingtalk-dispatcher", daemon=True)
+        self.worker.start()
+
+    @classmethod
+    def get(cls, webhook, rate_per_minute=20, max_bytes=MAX_PAYLOAD_BYTES):
+        with cls._registry_lock:
+            dispatcher = cls._dispatchers.get(webhook)
+            if dispatcher is None:
+                dispatcher = cls(rate_per_minute, max_bytes)
+                cls._dispatchers[webhook] = dispatcher
+            return dispatcher
+
+    @classmethod
+    def flush_all(cls, timeout=None):
+        with cls._registry_lock:
+            dispatchers = list(cls._dispatchers.values())
+        return all(dispatcher.flush(timeout) for dispatcher in dispatchers)
+
+    def submit(self, send, data, headers=None, deadline=None):
+        """deadline 为发送的截止时间（time.monotonic()），排队到截止时间仍未发出的消息不再发送"""
+        future = Future()
+        self.queue.put((send, data, headers, [future], deadline))
+        return future
+
+    def flush(self, timeout=None):
+        """等待队列中的消息发送完毕，超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    @staticmethod
+    def __merge_key(data):
+        msgtype = data.get("msgtype")
+        body = data.get(msgtype, {})
+        if msgtype == "text":
+            return msgtype, str(data.get("at"))
+        if msgtype == "markdown":
+            return msgtype, body.get("title"), str(data.get("at"))
+        if msgtype == "actionCard":
+            return msgtype, body.get("title"), str(body.get("btns")), body.get("btnOrientation")
+        return None
+
+    @staticmethod
+    def __merge(data, other):
+        msgtype = data.get("msgtype")
+        field = "content" if msgtype == "text" else "text"
+        body = dict(data[msgtype])
+        body[field] = f"{body[field]}\n\n---\n\n{other[msgtype][field]}"
+        return {**data, msgtype: body}
+
+    def __take_batch(self):
+        """
+        取出一条消息，等待限流令牌后，合并队列中紧随其后的同类消息。
+        被限流期间积压的消息因此会合并发送，合并后超过长度上限的不再合并。
+        """
+        while True:
+            send, data, headers, futures, deadline = self.queue.get()
+            if self.bucket.acquire(deadline):
+                break
+            logging.error("钉钉通知在发送期限内等不到限流令牌，不再发送")
+            for future in futures:
+                future.set_exception(TimeoutError("钉钉通知超出发送期限"))
+            self.queue.task_done()
+        taken = 1
+        key = self.__merge_key(data)
+        while key is not None:
+            try:
+                next_item = self.queue.queue[0]
+            except IndexError:
+                break
+            if self.__merge_key(next_item[1]) != key:
+                break
+            merged = self.__merge(data, next_item[1])
+            if payload_size(merged) > self.max_bytes:
+                break
+            self.queue.get_nowait()
+            taken += 1
+            data = merged
+            futures = futures + next_item[3]
+            if next_item[4] is not None:
+                deadline = next_item[4] if deadline is None else min(deadline, next_item[4])
+        if taken > 1:
+            logging.info(f"合并 {taken} 条钉钉通知为一条发送")
+        return send, data, headers, futures, deadline, taken
+
+    def __run(self):
+        while True:
+            send, data, headers, futures, deadline, taken = self.__take_batch()
+            try:
+                result = send(data, headers, deadline)
+                for future in futures:
+                    future.set_result(result)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
 
 
 class DingTalkBot(object):
-    def __init__(self, _webhook, _secret=None):
+    def __init__(self, _webhook, _secret=None, asynchronous=False, rate_per_minute=20,
+                 max_bytes=MAX_PAYLOAD_BYTES, timeout=None):
+        """
+        Args:
+            _webhook: 机器人 webhook
+            _secret: 加签密钥
+            asynchronous: 为 True 时 send_* 立即返回 Future，消息由后台队列限流发送
+            rate_per_minute: 每分钟最多发送的消息数，钉钉限制为 20
+            max_bytes: 单条消息请求体的上限，超过时发送前拆分为多条
+            timeout: 每次发送（包括排队、拆分后的多条和重试）的总时长上限（秒），None 为不限制
+        """
         self.webhook = _webhook
         self.secret = _secret
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.dispatcher = DingTalkDispatcher.get(_webhook, rate_per_minute, max_bytes) if asynchronous else None
 
     def __get_signature(self):
         timestamp = str(round(time.time() * 1000))
@@ -24,10 +302,22 @@ class DingTalkBot(object):
         sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
         return timestamp, sign
 
-    def __do_send_request(self, _data, _headers=None):
-        if self.secret:
-            self.webhook += "&timestamp={}&sign={}".format(*self.__get_signature())
-        res = requests.post(self.webhook, headers=_headers, json=_data)
+    def __signed_url(self):
+        """每次发送时重新签名，不修改 self.webhook"""
+        if not self.secret:
+            return self.webhook
+        separator = "&" if "?" in self.webhook else "?"
+        return "{}{}timestamp={}&sign={}".format(self.webhook, separator, *self.__get_signature())
+
+    def __do_send_request(self, _data, _headers=None, deadline=None):
+        headers = {**(_headers or {}), "Content-Type": "application/json; charset=utf-8"}
+        with time_request("dingtalk", "/robot/send") as timing:
+            # 重试由 __send_now 按钉钉的错误码处理，这里不再重复重试；
+            # 请求体与 payload_size 的编码方式一致，发送前的长度检查才准确
+            res = get_transport().request("POST", self.__signed_url(), headers=headers,
+                                          data=encode_payload(_data), retry=False, deadline=deadline,
+                                          service="dingtalk")
+            timing["status"] = str(res.status_code)
         if res.status_code == 200:
             res_json = res.json()
             if res_json.get("errmsg") == "ok":
@@ -40,31 +330,44 @@ class DingTalkBot(object):
             )
 
     def __send_request(self, _data, _headers=None):
+        messages = build_messages(_data, self.max_bytes)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        if self.dispatcher is not None:
+            futures = [self.dispatcher.submit(self.__send_now, message, _headers, deadline) for message in messages]
+            return futures[0] if len(futures) == 1 else _all_of(futures)
+        # 按顺序逐条发送，保证编号顺序
+        return all([self.__send_now(message, _headers, deadline) for message in messages])
+
+    def flush(self, timeout=None):
+        """等待后台队列中的消息发送完毕"""
+        if self.dispatcher is None:
+            return True
+        return self.dispatcher.flush(timeout)
+
+    def __send_now(self, _data, _headers=None, deadline=None):
+        transport = get_transport()
         for i in range(5):
             try:
-                self.__do_send_request(_data, _headers)
+                self.__do_send_request(_data, _headers, deadline)
                 logging.info("发送钉钉通知成功")
-                break
+                return True
             except Exception as e:
-                logging.error(f'发送钉钉通知失败，错误提示：{e.args[0].get("errmsg")}')
-                logging.warning("Wait 2 seconds and retry...")
-                time.sleep(2)
-                if e.args[0].get("errcode") == 460101:
-                    logging.warning("通知内容过长，已截断。")
-                    if _data.get("text") and _data.get("text").get("content"):
-                        _data.get("text").update(
-                            {
-                                "content": f'{_data.get("text").get("content")[:10000]}...'
-                            }
-                        )
-                    if _data.get("markdown") and _data.get("markdown").get("text"):
-                        _msg_body = "内容过长，不显示"
-                        _data.get("markdown").update(
-                            {
-                                "text": f'{_data.get("markdown").get("title")} \n\n {_msg_body}'
-                            }
-                        )
-                    continue
+                error = e.args[0] if e.args and isinstance(e.args[0], dict) else {"errmsg": str(e)}
+                logging.error(f'发送钉钉通知失败，错误提示：{error.get("errmsg")}')
+                if error.get("errcode") == 460101:
+                    # 发送前已按 max_bytes 拆分，仍超长说明上限配置有误，重试没有意义
+                    logging.error(f"通知内容过长（{payload_size(_data)} 字节），请调小 max_bytes")
+                    break
+                if i == 4:
+                    break
+                delay = transport.backoff(i)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    logging.error("发送钉钉通知超出发送期限，不再重试")
+                    break
+                logging.warning(f"Wait {delay:.2f} seconds and retry...")
+                HTTP_RETRIES.inc(service="dingtalk")
+                time.sleep(delay)
+        return False
 
     def send_text(self, _text):
         headers = {
@@ -76,7 +379,7 @@ class DingTalkBot(object):
                 "content": _text,
             },
         }
-        self.__send_request(data, headers)
+        return self.__send_request(data, headers)
 
     def send_markdown(self, title, text, at_mobiles=None, at_user_ids=None):
         if at_user_ids is None:
@@ -92,7 +395,7 @@ class DingTalkBot(object):
                 "isAtAll": False,
             },
         }
-        self.__send_request(data)
+        return self.__send_request(data)
 
     def send_action_card(self, title, text, btns=[], btn_orientation=0):
         """独立跳转 ActionCard 类型
@@ -112,4 +415,4 @@ class DingTalkBot(object):
                 "btns": btns,
             },
         }
-        self.__send_request(data)
+        return self.__send_request(data)
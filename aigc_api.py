@@ -1,12 +1,21 @@
+import functools
 import logging
+import threading
 import time
 
 import requests
-from urllib.parse import urljoin
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
 from datetime import datetime
 
 from config import config
 from enums.log_type import LogType
+from http_client import CircuitOpenError, get_transport
+from log_cursor import load_cursor, save_cursor
+from log_stats import ModelBreakdown
+from metrics import HTTP_RETRIES, LOG_PAGES, time_request
+from session_store import load_cookies, save_cookies
 
 def get_start_of_day_timestamp():
     # 获取当前日期
@@ -18,6 +27,30 @@ def get_start_of_day_timestamp():
     return start_timestamp
 
 
+class SessionExpired(Exception):
+    """
+    会话失效（401 或提示未登录的 success: false），由 require_login 捕获后重新登录
+    """
+
+
+# success: false 时表示会话失效的提示，其他错误（如令牌不存在）直接返回给调用方，不触发重新登录
+SESSION_EXPIRED_MESSAGES = ("未登录", "access token", "not logged in", "unauthorized")
+
+
+def is_session_expired(rj: dict) -> bool:
+    message = str(rj.get("message") or "").lower()
+    return any(keyword in message for keyword in SESSION_EXPIRED_MESSAGES)
+
+
+def to_timestamp(value) -> int:
+    """
+    将 datetime 或时间戳转换为整数时间戳
+    """
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
 class AigcApi:
     headers = {
         "accept": "application/json, text/plain, */*",
@@ -33,11 +66,45 @@ class AigcApi:
         "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
     }
 
-    def __init__(self):
-        self.session = requests.session()
-        self.turboai = config.get_turboai()
+    def __init__(self, account: dict = None):
+        self.transport = get_transport()
+        # 每个账号使用独立的 session 保存 cookie，连接池由传输层按 host 共享
+        self.session = self.transport.new_session()
+        # 账号配置，默认使用 [turboai]，见 config.get_accounts
+        self.turboai = config.get_turboai() if account is None else account
         self.host_url = self.turboai.get("host")
         self.logged = False
+        self.login_count = 0
+        self._login_lock = threading.Lock()
+        # 标记当前线程是否处于重新登录后的重试中
+        self._local = threading.local()
+        self._restore_session()
+        self.log_concurrency = max(1, int(self.turboai.get("log_concurrency", 1)))
+
+    @property
+    def session_key(self):
+        return f"{self.host_url}|{self.turboai.get('username')}"
+
+    def _restore_session(self):
+        """
+        从本地恢复上次登录的 cookie，恢复后先视为已登录，失效时由 require_login 重新登录
+        """
+        cookie_path = self.turboai.get("session_cookie_path", "session_cookies.json")
+        cookies = load_cookies(cookie_path, self.session_key)
+        if cookies:
+            self.session.cookies.update(cookies)
+            self.logged = True
+            logging.debug(f"已恢复 {self.session_key} 的登录会话")
+
+    def _save_session(self):
+        cookie_path = self.turboai.get("session_cookie_path", "session_cookies.json")
+        save_cookies(cookie_path, self.session_key, requests.utils.dict_from_cookiejar(self.session.cookies))
+
+    def ensure_login(self):
+        """
+        未登录时登录，已有会话时直接返回
+        """
+        return self.logged or self.login()
 
     def login(self, max_attempts=5):
         for attempt in range(max_attempts):
@@ -46,43 +113,103 @@ class AigcApi:
                 "password": self.turboai.get("password"),
             }
             url = urljoin(self.host_url, "/api/user/login")
-            response = self.session.post(url=url, headers=self.headers, json=json_data)
-            rj = response.json()
+            try:
+                with time_request("uniapi", "/api/user/login") as timing:
+                    # 重试和退避由外层循环负责，这里只请求一次
+                    response = self.transport.request(
+                        "POST", url, session=self.session, headers=self.headers, json=json_data, retry=False,
+                        service="uniapi",
+                    )
+                    timing["status"] = str(response.status_code)
+                    rj = response.json()
+            except CircuitOpenError as e:
+                logging.error(f"Login failed: {e}")
+                return False
+            except (requests.RequestException, ValueError) as e:
+                rj = {"success": False, "message": str(e)}
             if rj.get("success"):
                 self.logged = True
+                self.login_count += 1
+                self._save_session()
                 logging.info("Login successful.")
                 return True
             else:
                 logging.error(f"Login failed, response: {rj}")
                 # 延迟，避免过于频繁的尝试
                 if attempt < max_attempts - 1:
+                    HTTP_RETRIES.inc(service="uniapi")
                     logging.warning(f"Login failed. Retrying ({attempt + 1}/{max_attempts})...")
-                    time.sleep(2)  # 等待2秒后再尝试
+                    time.sleep(self.transport.backoff(attempt))
         logging.error("Login failed. Maximum attempts reached.")
         return False
 
+    def _relogin(self, login_count):
+        """
+        会话失效后重新登录。多个线程同时发现失效时只登录一次
+        """
+        with self._login_lock:
+            if self.login_count != login_count and self.logged:
+                return True
+            self.logged = False
+            return self.login()
+
     @staticmethod
     def require_login(func):
+        @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
             if not self.logged:
-                if not self.login():
+                with self._login_lock:
+                    if not self.logged and not self.login():
+                        raise Exception("Login failed. Please check your credentials.")
+            login_count = self.login_count
+            try:
+                return func(self, *args, **kwargs)
+            except SessionExpired as e:
+                if getattr(self._local, "retrying", False):
+                    raise
+                logging.warning(f"Session expired, login again. response: {e}")
+                HTTP_RETRIES.inc(service="uniapi")
+                if not self._relogin(login_count):
                     raise Exception("Login failed. Please check your credentials.")
-            return func(self, *args, **kwargs)
+            retrying = getattr(self._local, "retrying", False)
+            self._local.retrying = True
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._local.retrying = retrying
         return wrapper
 
+    def _get_json(self, url, params=None, deadline=None):
+        """
+        发送 GET 请求并返回 json。返回 401 或提示未登录的 success: false 时视为会话失效，
+        重新登录后的重试中只有 401 才视为失效。其他 success: false 原样返回。
+        deadline 为截止时间（time.monotonic()），包括重试在内不超过该时间
+        """
+        path = urlparse(url).path
+        endpoint = "/api/token/{id}" if path.startswith("/api/token/") else path
+        with time_request("uniapi", endpoint) as timing:
+            res = self.transport.request("GET", url, session=self.session, params=params, headers=self.headers,
+                                         deadline=deadline, service="uniapi")
+            timing["status"] = str(res.status_code)
+            if res.status_code == 401:
+                raise SessionExpired(f"HTTP {res.status_code}")
+            rj = res.json()
+        if (not rj.get("success", False) and is_session_expired(rj)
+                and not getattr(self._local, "retrying", False)):
+            raise SessionExpired(rj)
+        return rj
+
     @require_login
     def get_self(self):
         url = urljoin(self.host_url, "/api/user/self")
-        response = self.session.get(url=url, headers=self.headers)
-        return response.json()
+        return self._get_json(url)
 
     @require_login
-    def get_token(self, key_id: str = None):
+    def get_token(self, key_id: str = None, deadline: float = None):
         if key_id is None:
             key_id = self.turboai.get("key_id")
         url = urljoin(self.host_url, f"/api/token/{key_id}")
-        res = self.session.get(url=url, headers=self.headers)
-        rj = res.json()
+        rj = self._get_json(url, deadline=deadline)
         return rj
 
     @require_login
@@ -93,8 +220,7 @@ class AigcApi:
         :return: Tuple of (today's request count, today's cost, today's token usage)
         """
         url = urljoin(self.host_url, "/api/user/dashboard")
-        res = self.session.get(url=url, headers=self.headers)
-        rj = res.json()
+        rj = self._get_json(url)
         success = rj.get("success")
         if not bool(success):
             logging.error(f"Unexpected error: {rj}")
@@ -118,14 +244,163 @@ class AigcApi:
         return today_request_count, today_cost, total_tokens_today
 
     @require_login
-    def get_dashboard_with_log(self, start_timestamp: int = None, end_timestamp: int = None):
+    def _fetch_log_page(self, page: int, size: int, token_name: str, start_timestamp: int, end_timestamp: int,
+                        log_type: LogType = LogType.CONSUME, model_name: str = '', deadline: float = None):
+        """
+        获取一页日志
+
+        :return: Tuple of (log entries, total count)
+        """
+        url = urljoin(self.host_url, "/api/log/self")
+        params = {
+            'page': page,
+            'size': size,
+            'order': '-created_at',
+            'p': '0',
+            'token_name': token_name,
+            'model_name': model_name,
+            'start_timestamp': start_timestamp,
+            'end_timestamp': end_timestamp,
+            'log_type': log_type.code,
+        }
+        rj = self._get_json(url, params, deadline)
+        LOG_PAGES.inc()
+        # 检查是否成功
+        success = rj.get("success", False)
+        if not success:
+            logging.error(f"Unexpected error: {rj}")
+            raise Exception(f"Unexpected error: {rj}")
+        page_info = rj.get("data", {})
+        return page_info.get("data", []), page_info.get("total_count", 0)
+
+    def _iter_log_pages(self, token_name: str, start_timestamp: int, end_timestamp: int,
+                        size: int = 100, concurrency: int = None, deadline: float = None, usage: dict = None,
+                        **filters):
+        """
+        按页顺序返回日志。先读取第一页得到 total_count，
+        并发数大于 1 时其余页通过线程池同时拉取，再按页码顺序返回。
+        同时在途的页数不超过并发数，内存占用与总页数无关。
+
+        end_timestamp 固定且不晚于现在，因此拉取过程中新产生的日志不会导致分页错位。
+        会话失效在每一页的请求中处理，重新登录后只重试失效的那一页。
+        到达 deadline（time.monotonic()）后不再拉取，已返回的页为部分结果，并在 usage 中标记 partial
+        """
+        try:
+            yield from self._iter_log_pages_until(token_name, start_timestamp, end_timestamp, size, concurrency,
+                                                  deadline, **filters)
+        except requests.Timeout:
+            if deadline is None or time.monotonic() < deadline:
+                raise
+            logging.warning(f"拉取 {token_name} 的日志超出本次时间预算，返回部分结果")
+            if usage is not None:
+                usage["partial"] = True
+
+    def _iter_log_pages_until(self, token_name: str, start_timestamp: int, end_timestamp: int, size: int,
+                              concurrency: int, deadline: float, **filters):
+        end_timestamp = min(end_timestamp, int(time.time()))
+        concurrency = self.log_concurrency if concurrency is None else max(1, concurrency)
+        data, total_count = self._fetch_log_page(1, size, token_name, start_timestamp, end_timestamp,
+                                                 deadline=deadline, **filters)
+        if not data:
+            return
+        yield data
+        total_pages = (total_count + size - 1) // size
+        if total_pages <= 1:
+            return
+
+        if concurrency == 1:
+            page = 2
+            while True:
+                data, _ = self._fetch_log_page(page, size, token_name, start_timestamp, end_timestamp,
+                                               deadline=deadline, **filters)
+                if not data:
+                    break
+                yield data
+                # 检查是否已经是最后一页
+                if (page - 1) * size + len(data) >= total_count:
+                    break
+                page += 1
+            return
+
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, total_pages - 1))
+        pending = deque()
+        pages = iter(range(2, total_pages + 1))
+
+        def submit_next():
+            page = next(pages, None)
+            if page is not None:
+                pending.append(executor.submit(
+                    self._fetch_log_page, page, size, token_name, start_timestamp, end_timestamp,
+                    deadline=deadline, **filters
+                ))
+
+        try:
+            for _ in range(concurrency):
+                submit_next()
+            while pending:
+                data, _ = pending.popleft().result()
+                if not data:
+                    break
+                submit_next()
+                yield data
+        finally:
+            # 调用方提前停止时，取消尚未开始的请求
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_logs(self, start, end=None, log_type: LogType = LogType.CONSUME, token_name: str = '',
+                  model_name: str = '', size: int = 100, concurrency: int = 1):
+        """
+        逐条返回时间范围内的日志，每次只拉取一页，按时间倒序。
+
+        :param start: 开始时间，时间戳或 datetime
+        :param end: 结束时间，时间戳或 datetime，默认为现在，晚于现在时按现在处理
+        :param log_type: 日志类型
+        :param token_name: 令牌名称，为空时返回所有令牌的日志
+        :param model_name: 模型名称，为空时不过滤
+        :param size: 每页条数
+        :param concurrency: 同时拉取的页数，大于 1 时会预先拉取后续页
+        """
+        start_timestamp = to_timestamp(start)
+        end_timestamp = int(datetime.now().timestamp()) if end is None else to_timestamp(end)
+        for data in self._iter_log_pages(token_name, start_timestamp, end_timestamp, size, concurrency,
+                                         log_type=log_type, model_name=model_name):
+            yield from data
+
+    def format_dashboard(self, request_count: int, prompt_tokens: int, completion_tokens: int, quota: int):
+        """
+        将今日统计转换为报告中展示的形式
+
+        :return: Tuple of (request count, cost in currency units, formatted token usage)
+        """
+        total_tokens = prompt_tokens + completion_tokens
+        total_tokens = f'{total_tokens / 1000:.2f}k' if total_tokens > 1000 else f'{total_tokens}'
+        units = self.turboai.get("units", 500000)
+        cost = round(quota / units, 3)
+        return request_count, cost, total_tokens
+
+    def get_dashboard_with_log(self, start_timestamp: int = None, end_timestamp: int = None, incremental: bool = None,
+                               key_id: str = None, token_name: str = None, breakdown: ModelBreakdown = None,
+                               usage: dict = None, deadline: float = None):
         """
         通过日志获取仪表板数据，包括今天的请求计数、成本和token使用情况。
 
+        :param key_id: 令牌 id，默认为配置中的 key_id
+        :param token_name: 令牌名称，已知时传入可省去一次 get_token 请求
+        :param breakdown: 传入时同时按模型统计，结果累加到其中
+        :param incremental: 增量模式，仅在统计今天（未指定 start_timestamp）时生效，默认读取配置 incremental_log
+        :param usage: 传入时将本次拉取的日志页数累加到 usage["pages"]，超出 deadline 时设置 usage["partial"]
+        :param deadline: 截止时间（time.monotonic()），到达后停止拉取日志，返回已拉取部分的统计
         :return: Tuple of (today's request count, today's cost, today's token usage)
         """
         self.headers['referer'] = 'https://api.uniapi.me/panel/log'
-        token_name = self.get_token()['data']['name']
+        if token_name is None:
+            token_name = self.get_token(key_id, deadline)['data']['name']
+        if incremental is None:
+            incremental = self.turboai.get("incremental_log", False)
+        if usage is None:
+            usage = {}
+        if incremental and start_timestamp is None:
+            return self._get_dashboard_incremental(token_name, end_timestamp, breakdown, usage, deadline)
         start_timestamp = get_start_of_day_timestamp() if start_timestamp is None else start_timestamp
         end_timestamp = int(datetime.now().timestamp()) if end_timestamp is None else end_timestamp
         # 初始化变量存储今天的统计数据
@@ -134,52 +409,74 @@ class AigcApi:
         today_completion_tokens = 0
         today_cost = 0
 
-        page = 1
-        size = 100
-        total_count = 0  # 初始化总条数
-        url = urljoin(self.host_url, "/api/log/self")
-        while True:
-            params = {
-                'page': page,
-                'size': size,
-                'order': '-created_at',
-                'p': '0',
-                'token_name': token_name,
-                'model_name': '',
-                'start_timestamp': start_timestamp,
-                'end_timestamp': end_timestamp,
-                'log_type': LogType.CONSUME.code,
-            }
-            res = self.session.get(url=url, params=params, headers=self.headers)
-            rj = res.json()
-            # 检查是否成功
-            success = rj.get("success", False)
-            if not success:
-                logging.error(f"Unexpected error: {rj}")
-                raise Exception(f"Unexpected error: {rj}")
-            data = rj.get("data", {}).get("data", [])
-            if not data:
-                break
+        page_count = 0
+        for data in self._iter_log_pages(token_name, start_timestamp, end_timestamp, deadline=deadline, usage=usage):
+            page_count += 1
             # 更新统计数据
             for entry in data:
                 today_request_count += 1
                 today_prompt_tokens += entry["prompt_tokens"]
                 today_completion_tokens += entry["completion_tokens"]
                 today_cost += entry["quota"]
-            # 检查是否已经是最后一页
-            current_page_info = rj.get("data", {})
-            current_total_count = current_page_info.get("total_count", 0)
-            if total_count == 0:
-                total_count = current_total_count  # 第一次获取总条数
-            if (page - 1) * size + len(data) >= total_count:
-                break
-            page += 1
+            if breakdown is not None:
+                breakdown.add_page(data)
+        usage["pages"] = usage.get("pages", 0) + page_count
 
-        total_tokens_today = today_prompt_tokens + today_completion_tokens
-        total_tokens_today = f'{total_tokens_today / 1000:.2f}k' if total_tokens_today > 1000 else f'{total_tokens_today}'
-        units = config.get("turboai", "units", 500000)
-        today_cost = round(today_cost / units, 3)
-        return today_request_count, today_cost, total_tokens_today
+        return self.format_dashboard(today_request_count, today_prompt_tokens, today_completion_tokens, today_cost)
+
+    def _get_dashboard_incremental(self, token_name: str, end_timestamp: int = None,
+                                   breakdown: ModelBreakdown = None, usage: dict = None, deadline: float = None):
+        """
+        增量统计今天的日志：只拉取游标之后的新日志，出现早于高水位的日志即停止。
+        游标保存在本地文件中，进程重启后继续使用，跨天自动重置。
+        超出 deadline 时只拉取到了最新的一部分日志，统计中包含这部分，但不保存游标，下次仍从原高水位拉取
+        """
+        usage = {} if usage is None else usage
+        day_start = get_start_of_day_timestamp()
+        end_timestamp = int(datetime.now().timestamp()) if end_timestamp is None else end_timestamp
+        cursor_path = self.turboai.get("log_cursor_path", "log_cursor.json")
+        by_channel = breakdown.by_channel if breakdown is not None else None
+        cursor = load_cursor(cursor_path, f"{self.host_url}|{token_name}", day_start, by_channel)
+        # 从高水位所在的那一秒开始拉取，该秒内已统计的日志通过 id 去重
+        start_timestamp = max(day_start, cursor.last_created_at)
+        new_entries, page_count = cursor.collect_new(
+            self._iter_log_pages(token_name, start_timestamp, end_timestamp, deadline=deadline, usage=usage)
+        )
+
+        # 日志按时间倒序返回，按正序累加以推进高水位
+        for entry in reversed(new_entries):
+            cursor.add(entry)
+        if new_entries and not usage.get("partial"):
+            save_cursor(cursor_path, cursor)
+        if breakdown is not None:
+            breakdown.merge(cursor.models)
+        usage["pages"] = usage.get("pages", 0) + page_count
+        logging.debug(f"增量统计 {token_name}: 新增 {len(new_entries)} 条日志，共请求 {page_count} 页")
+        return self.format_dashboard(cursor.request_count, cursor.prompt_tokens, cursor.completion_tokens, cursor.quota)
+
+
+class SessionManager:
+    """
+    进程级别的会话管理，同一账号在多次定时任务之间复用同一个已登录的 AigcApi
+    """
+
+    def __init__(self):
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    def get(self, account: dict = None) -> AigcApi:
+        account = config.get_turboai() if account is None else account
+        key = (account.get("host"), account.get("username"))
+        with self._lock:
+            aigc_api = self._apis.get(key)
+            # 账号配置变化（如密码修改）时重新创建会话
+            if aigc_api is None or aigc_api.turboai != account:
+                aigc_api = AigcApi(account)
+                self._apis[key] = aigc_api
+            return aigc_api
+
+
+session_manager = SessionManager()
 
 
 if __name__ == "__main__":
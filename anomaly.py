@@ -0,0 +1,278 @@
+"""
+消费异常检测：每分钟只拉取新增的消费日志，按令牌和模型更新每分钟消费额、请求数的 EWMA 均值和方差，
+超出基线时立即发送告警
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import Optional
+
+from enums.log_type import LogType
+from json_state import load_json, save_json
+
+TOTAL = "*"
+
+
+class EwmaStat:
+    """
+    指数加权的均值和方差
+
+    Args:
+        alpha: 平滑系数，越大越偏重最近的数据
+    """
+
+    def __init__(self, alpha: float = 0.05, mean: float = 0.0, var: float = 0.0, n: int = 0):
+        self.alpha = alpha
+        self.mean = mean
+        self.var = var
+        self.n = n
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.var)
+
+    def update(self, value: float) -> None:
+        if self.n == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.var = (1 - self.alpha) * (self.var + diff * increment)
+        self.n += 1
+
+    def to_list(self) -> list:
+        return [self.mean, self.var, self.n]
+
+    @classmethod
+    def from_list(cls, alpha: float, data: list) -> "EwmaStat":
+        return cls(alpha, *data)
+
+
+class AnomalyDetector:
+    """
+    按令牌和模型维护每分钟消费额（quota）和请求数的基线
+
+    Args:
+        path: 状态文件路径
+        alpha: EWMA 平滑系数
+        threshold: 超过均值多少个标准差视为异常
+        min_samples: 基线至少积累多少分钟后才告警
+        min_quota: 每分钟消费额低于该值时不告警，避免低消费时的噪声
+        min_count: 每分钟请求数低于该值时不告警
+        cooldown: 同一令牌同一模型两次告警的最小间隔（秒）
+        max_gap: 两次检查间隔超过该分钟数时，只补齐最近 max_gap 分钟
+        name_ttl: 查询不到日志时，距上次确认令牌名称超过该秒数则重新查询名称（令牌可能已改名）
+    """
+
+    def __init__(self, path: str = "anomaly_state.json", alpha: float = 0.05, threshold: float = 4,
+                 min_samples: int = 30, min_quota: int = 50000, min_count: int = 20, cooldown: int = 600,
+                 max_gap: int = 60, name_ttl: int = 600):
+        self.path = path
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.min_quota = min_quota
+        self.min_count = min_count
+        self.cooldown = cooldown
+        self.max_gap = max_gap
+        self.name_ttl = name_ttl
+        self._lock = threading.Lock()
+        self._state = load_json(self.path, "异常检测状态")
+
+    def _save(self) -> None:
+        save_json(self.path, self._state, "异常检测状态")
+
+    def _check(self, stats: dict, model: str, quota: int, count: int, now: float) -> list[dict]:
+        """
+        用一分钟的数据对比基线（更新前的均值和方差），再更新基线
+        """
+        quota_stat = EwmaStat.from_list(self.alpha, stats.setdefault("quota", [0.0, 0.0, 0]))
+        count_stat = EwmaStat.from_list(self.alpha, stats.setdefault("count", [0.0, 0.0, 0]))
+        anomalies = []
+        if quota_stat.n >= self.min_samples and now - stats.get("alerted_at", 0) >= self.cooldown:
+            for field, value, stat, minimum in (
+                ("quota", quota, quota_stat, self.min_quota),
+                ("count", count, count_stat, self.min_count),
+            ):
+                if value >= minimum and value > stat.mean + self.threshold * stat.std:
+                    anomalies.append({"model": model, "field": field, "value": value,
+                                      "mean": stat.mean, "std": stat.std})
+            if anomalies:
+                stats["alerted_at"] = now
+        quota_stat.update(quota)
+        count_stat.update(count)
+        stats["quota"] = quota_stat.to_list()
+        stats["count"] = count_stat.to_list()
+        return anomalies
+
+    def process(self, key: str, entries: list[dict], end_minute: int, now: Optional[float] = None) -> list[dict]:
+        """
+        处理截至 end_minute（不含）的新日志，逐分钟更新基线。没有日志的分钟按 0 计入基线
+
+        Args:
+            key: 令牌键
+            entries: 水位之后新增的日志
+            end_minute: 已完整结束的最后一分钟的下一分钟的开始时间戳
+
+        Returns:
+            发现的异常列表
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            token_state = self._state.setdefault(key, {"watermark": None, "models": {}})
+            if token_state["watermark"] is None:
+                # 首次检查只记录水位，之后的检查从这一分钟开始统计
+                token_state["watermark"] = end_minute
+                self._save()
+            watermark = max(token_state["watermark"], end_minute - self.max_gap * 60)
+            minutes = max((end_minute - watermark) // 60, 0)
+            if not minutes:
+                return []
+            quota = {}
+            count = {}
+            for entry in entries:
+                created_at = entry.get("created_at", 0)
+                if not watermark <= created_at < end_minute:
+                    continue
+                index = (created_at - watermark) // 60
+                for model in (entry.get("model_name") or "unknown", TOTAL):
+                    quota.setdefault(model, [0] * minutes)[index] += entry.get("quota", 0)
+                    count.setdefault(model, [0] * minutes)[index] += 1
+
+            models = token_state["models"]
+            anomalies = []
+            for model in set(models) | set(quota):
+                stats = models.setdefault(model, {})
+                model_quota = quota.get(model, [0] * minutes)
+                model_count = count.get(model, [0] * minutes)
+                for index in range(minutes):
+                    for anomaly in self._check(stats, model, model_quota[index], model_count[index], now):
+                        anomaly["minute"] = watermark + index * 60
+                        anomalies.append(anomaly)
+            token_state["watermark"] = end_minute
+            self._save()
+        return anomalies
+
+    def watermark(self, key: str) -> Optional[int]:
+        with self._lock:
+            token_state = self._state.get(key)
+        return token_state["watermark"] if token_state else None
+
+    def token_name(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._state.get(key, {}).get("token_name")
+
+    def set_token_name(self, key: str, name: str, now: Optional[float] = None) -> None:
+        with self._lock:
+            token_state = self._state.setdefault(key, {"watermark": None, "models": {}})
+            token_state["token_name"] = name
+            token_state["name_checked_at"] = time.time() if now is None else now
+
+    def name_stale(self, key: str, now: float) -> bool:
+        with self._lock:
+            return now - self._state.get(key, {}).get("name_checked_at", 0) >= self.name_ttl
+
+
+def format_anomalies(key: str, anomalies: list[dict], units: int, currency: str) -> str:
+    text = f"**消费异常告警** ({key})"
+    for anomaly in anomalies:
+        minute = time.strftime("%H:%M", time.localtime(anomaly["minute"]))
+        model = "全部模型" if anomaly["model"] == TOTAL else anomaly["model"]
+        if anomaly["field"] == "quota":
+            value = f"{currency}{round(anomaly['value'] / units, 3)}/分钟"
+            baseline = f"{currency}{round(anomaly['mean'] / units, 3)}"
+            text += f"  \n  - {minute} {model} 消费 {value}，基线 {baseline}"
+        else:
+            text += f"  \n  - {minute} {model} 请求 {anomaly['value']}次/分钟，基线 {anomaly['mean']:.1f}次"
+    return text
+
+
+def check_token(detector: AnomalyDetector, aigc_api, key_id, now: Optional[float] = None) -> list[dict]:
+    """
+    拉取令牌水位之后、已完整结束的分钟内的日志并检测异常，拉取量与新增日志数成正比
+    """
+    now = time.time() if now is None else now
+    key = f"{aigc_api.turboai.get('name')}/{key_id}"
+
+    def refresh_name() -> str:
+        token_data = aigc_api.get_token(key_id)
+        if not token_data.get("success"):
+            raise RuntimeError(token_data.get("message") or "令牌查询失败")
+        name = token_data["data"]["name"]
+        detector.set_token_name(key, name, now)
+        return name
+
+    token_name = detector.token_name(key)
+    if token_name is None:
+        token_name = refresh_name()
+
+    end_minute = int(now) // 60 * 60
+    watermark = detector.watermark(key)
+    entries = []
+    if watermark is not None and watermark < end_minute:
+        start = max(watermark, end_minute - detector.max_gap * 60)
+        # 接口的 end_timestamp 包含边界，减一秒只拉取已结束的分钟
+        entries = list(aigc_api.iter_logs(start, end_minute - 1, log_type=LogType.CONSUME, token_name=token_name))
+        if not entries and detector.name_stale(key, now):
+            # 日志按令牌名称查询，令牌改名后旧名称查不到日志
+            new_name = refresh_name()
+            if new_name != token_name:
+                logging.info(f"令牌 {key} 已改名: {token_name} -> {new_name}")
+                entries = list(aigc_api.iter_logs(start, end_minute - 1, log_type=LogType.CONSUME,
+                                                  token_name=new_name))
+    return detector.process(key, entries, end_minute, now)
+
+
+def run_anomaly_check() -> None:
+    """
+    检查所有令牌，发现异常时立即发送告警到所有通知渠道
+    """
+    from aigc_api import session_manager
+    from config import config
+    from notifier import get_notifier
+
+    detector = get_anomaly_detector()
+    for account in config.get_accounts():
+        aigc_api = session_manager.get(account)
+        if not aigc_api.ensure_login():
+            continue
+        for key_id in account.get("key_ids", []):
+            try:
+                anomalies = check_token(detector, aigc_api, key_id)
+            except Exception as e:
+                logging.error(f"异常检测失败({account.get('name')}/{key_id}), msg: {e}")
+                continue
+            if not anomalies:
+                continue
+            key = f"{account.get('name')}/{key_id}"
+            text = format_anomalies(key, anomalies, account.get("units", 500000), account.get("currency", "¥"))
+            logging.warning(text)
+            get_notifier().send_markdown("消费异常告警", text)
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_anomaly_detector() -> AnomalyDetector:
+    """
+    获取进程内共享的异常检测器，参数来自配置 [anomaly]
+    """
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            from config import config
+
+            _detector = AnomalyDetector(
+                path=config.get("anomaly", "state_path", "anomaly_state.json"),
+                alpha=config.get("anomaly", "alpha", 0.05),
+                threshold=config.get("anomaly", "threshold", 4),
+                min_samples=config.get("anomaly", "min_samples", 30),
+                min_quota=config.get("anomaly", "min_quota", 50000),
+                min_count=config.get("anomaly", "min_count", 20),
+                cooldown=config.get("anomaly", "cooldown", 600),
+            )
+        return _detector
@@ -0,0 +1,226 @@
+"""
+按时间窗口并行回填历史日志统计，每完成一个窗口写入检查点，中断后重新运行会跳过已完成的窗口
+
+示例：
+    python backfill.py 2024-07-01 2024-07-31 --window day --concurrency 4 --checkpoint 2024-07.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from aigc_api import session_manager
+from config import config
+from enums.log_type import LogType
+from export_logs import parse_day
+from log_stats import ModelBreakdown
+
+WINDOWS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+
+def split_windows(start: datetime, end: datetime, window: str = "day") -> list[tuple[int, int]]:
+    """
+    将 [start, end) 按小时或按天切分为左闭右开的时间窗口
+
+    Returns:
+        [(窗口开始时间戳, 窗口结束时间戳), ...]
+    """
+    step = WINDOWS[window]
+    windows = []
+    current = start
+    while current < end:
+        window_end = min(current + step, end)
+        windows.append((int(current.timestamp()), int(window_end.timestamp())))
+        current = window_end
+    return windows
+
+
+class Checkpoint:
+    """
+    回填检查点，记录已完成窗口的统计。参数与已有检查点不一致时拒绝继续，避免混入不同条件的统计
+
+    Args:
+        path: 检查点文件路径
+        meta: 回填参数（账号、令牌、日志类型、窗口大小等）
+    """
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.meta = meta
+        self.windows = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("meta") != meta:
+                raise ValueError(f"检查点 {path} 的参数与本次不一致: {data.get('meta')}")
+            self.windows = data.get("windows", {})
+
+    def done(self, window_start: int) -> bool:
+        return str(window_start) in self.windows
+
+    def save_window(self, window_start: int, result: dict) -> None:
+        with self._lock:
+            self.windows[str(window_start)] = result
+            if result["end"] > time.time():
+                # 尚未结束的窗口（如今天）之后还会有新日志，只参与本次汇总，不写入检查点
+                return
+            tmp_path = f"{self.path}.tmp"
+            finished = {key: value for key, value in self.windows.items() if value["end"] <= time.time()}
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"meta": self.meta, "windows": finished}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+
+def fetch_window(aigc_api, window_start: int, window_end: int, log_type: LogType = LogType.CONSUME,
+                 token_name: str = "", raw_dir: str = None) -> dict:
+    """
+    拉取并统计一个窗口内的日志，指定 raw_dir 时同时将原始日志写入 {raw_dir}/{window_start}.jsonl
+
+    Returns:
+        窗口统计，可直接写入检查点
+    """
+    breakdown = ModelBreakdown()
+    raw_file = raw_path = None
+    if raw_dir:
+        raw_path = os.path.join(raw_dir, f"{window_start}.jsonl")
+        raw_file = open(f"{raw_path}.tmp", "w", encoding="utf-8")
+    try:
+        # 接口的 end_timestamp 包含边界，减一秒使区间左闭右开
+        for entry in aigc_api.iter_logs(window_start, window_end - 1, log_type=log_type, token_name=token_name):
+            breakdown.add(entry)
+            if raw_file is not None:
+                raw_file.write(json.dumps(entry, ensure_ascii=False))
+                raw_file.write("\n")
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+    if raw_path is not None:
+        # 窗口完整拉取后才出现正式文件，中断留下的 .tmp 在下次运行时覆盖
+        os.replace(f"{raw_path}.tmp", raw_path)
+    return {
+        "end": window_end,
+        "count": sum(breakdown.counts),
+        "prompt_tokens": sum(breakdown.prompt_tokens),
+        "completion_tokens": sum(breakdown.completion_tokens),
+        "quota": sum(breakdown.quota),
+        "models": breakdown.to_dict(),
+    }
+
+
+def backfill(aigc_api, windows: list[tuple[int, int]], checkpoint: Checkpoint, concurrency: int = 4,
+             log_type: LogType = LogType.CONSUME, token_name: str = "", raw_dir: str = None) -> list[int]:
+    """
+    并行拉取未完成的窗口，每完成一个立即写入检查点
+
+    Returns:
+        失败的窗口开始时间戳
+    """
+    pending = [window for window in windows if not checkpoint.done(window[0])]
+    logging.info(f"共 {len(windows)} 个窗口，已完成 {len(windows) - len(pending)} 个")
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(fetch_window, aigc_api, window_start, window_end, log_type, token_name, raw_dir):
+                window_start
+            for window_start, window_end in pending
+        }
+        try:
+            for future in as_completed(futures):
+                window_start = futures[future]
+                try:
+                    checkpoint.save_window(window_start, future.result())
+                    logging.info(f"窗口 {datetime.fromtimestamp(window_start)} 完成")
+                except Exception as e:
+                    logging.error(f"窗口 {datetime.fromtimestamp(window_start)} 失败, msg: {e}")
+                    failed.append(window_start)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    return sorted(failed)
+
+
+def summarize(checkpoint: Checkpoint, windows: list[tuple[int, int]]) -> tuple[dict, ModelBreakdown]:
+    """
+    合并所有已完成窗口的统计
+    """
+    total = {"windows": 0, "count": 0, "prompt_tokens": 0, "completion_tokens": 0, "quota": 0}
+    breakdown = ModelBreakdown()
+    for window_start, _ in windows:
+        result = checkpoint.windows.get(str(window_start))
+        if result is None:
+            continue
+        total["windows"] += 1
+        for field in ("count", "prompt_tokens", "completion_tokens", "quota"):
+            total[field] += result[field]
+        breakdown.merge(ModelBreakdown.from_dict(result["models"]))
+    return total, breakdown
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按时间窗口并行回填 UniAPI 日志统计")
+    parser.add_argument("start", type=parse_day, help="开始日期（含），如 2024-07-01")
+    parser.add_argument("end", type=parse_day, help="结束日期（含），如 2024-07-31")
+    parser.add_argument("--window", choices=list(WINDOWS), default="day", help="窗口大小")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时拉取的窗口数")
+    parser.add_argument("--checkpoint", help="检查点文件，默认按日期范围命名")
+    parser.add_argument("--raw-dir", help="同时将每个窗口的原始日志写入该目录")
+    parser.add_argument("--account", help="账号名称，默认为第一个账号")
+    parser.add_argument("--token-name", default="", help="令牌名称，默认统计所有令牌")
+    parser.add_argument("--log-type", choices=[log_type.name for log_type in LogType], default=LogType.CONSUME.name)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    accounts = config.get_accounts()
+    if args.account:
+        accounts = [account for account in accounts if account.get("name") == args.account]
+        if not accounts:
+            parser.error(f"未找到账号: {args.account}")
+    account = accounts[0]
+    aigc_api = session_manager.get(account)
+
+    windows = split_windows(args.start, args.end + timedelta(days=1), args.window)
+    meta = {
+        "account": account.get("name"),
+        "host": account.get("host"),
+        "token_name": args.token_name,
+        "log_type": args.log_type,
+        "window": args.window,
+    }
+    checkpoint_path = args.checkpoint or (
+        f"backfill_{args.start:%Y%m%d}_{args.end:%Y%m%d}_{args.window}.json"
+    )
+    if args.raw_dir:
+        os.makedirs(args.raw_dir, exist_ok=True)
+    try:
+        checkpoint = Checkpoint(checkpoint_path, meta)
+    except ValueError as e:
+        parser.error(str(e))
+
+    failed = backfill(aigc_api, windows, checkpoint, args.concurrency, LogType[args.log_type],
+                      args.token_name, args.raw_dir)
+    total, breakdown = summarize(checkpoint, windows)
+    units = account.get("units", 500000)
+    currency = account.get("currency", "¥")
+    print(f"完成窗口: {total['windows']}/{len(windows)}")
+    print(f"请求数: {total['count']}")
+    print(f"Token: {total['prompt_tokens'] + total['completion_tokens']}")
+    print(f"消费: {currency}{round(total['quota'] / units, 3)}")
+    for item in breakdown.top(config.get("report", "top_models", 5) or None):
+        print(f"  - {item['model']}: {currency}{round(item['quota'] / units, 3)} / {item['count']}次")
+    if failed:
+        print(f"{len(failed)} 个窗口失败，重新运行相同命令将只拉取未完成的窗口", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+离线基准测试：使用本地模拟的 UniAPI 和钉钉接口，结果写入 JSON 文件，便于对比不同版本
+
+    python bench/run_bench.py --rows 5000 --latency-ms 20 --output bench_results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from stub_server import StubState, start_stub_server  # noqa: E402
+
+CONFIG_TEMPLATE = """
+[active_dingtalk]
+active = "bench"
+
+[dingtalk-bench]
+webhook = "{base_url}/robot/send?access_token=bench"
+secret = "bench-secret"
+
+[turboai]
+host = "{base_url}"
+key_id = "1"
+currency = "$"
+username = "bench"
+password = "bench"
+units = 500000
+incremental_log = false
+log_cursor_path = "log_cursor.json"
+log_concurrency = {concurrency}
+session_cookie_path = "session_cookies.json"
+
+[report]
+today_hours = [0, 23]
+
+[store]
+path = "quota.db"
+"""
+
+
+def summarize(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "min_ms": round(samples[0] * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_job(state: StubState, runs: int) -> dict:
+    """
+    完整执行一次 do_job_aigc（登录会话复用、查询令牌、分页统计日志、发送钉钉通知）的耗时
+    """
+    import main
+    from notifier import get_notifier
+
+    main.first_run = False
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        main.do_job_aigc()
+        get_notifier().flush(timeout=60)
+        samples.append(time.perf_counter() - started)
+    result = summarize(samples)
+    result["rows"] = len(state.logs)
+    return result
+
+
+def bench_job_async(state: StubState, runs: int) -> dict:
+    """
+    异步版本 do_job_aigc_async 的耗时
+    """
+    import asyncio
+
+    import main
+    from notifier import get_notifier
+
+    main.first_run = False
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        asyncio.run(main.do_job_aigc_async())
+        get_notifier().flush(timeout=60)
+        samples.append(time.perf_counter() - started)
+    result = summarize(samples)
+    result["rows"] = len(state.logs)
+    return result
+
+
+def bench_log_paging(state: StubState, runs: int, concurrency: int) -> dict:
+    """
+    分页拉取并统计当天全部日志的速度
+    """
+    from aigc_api import session_manager
+
+    aigc_api = session_manager.get()
+    aigc_api.ensure_login()
+    aigc_api.log_concurrency = concurrency
+    samples = []
+    pages = 0
+    for _ in range(runs):
+        before = state.requests.get("/api/log/self", 0)
+        started = time.perf_counter()
+        aigc_api.get_dashboard_with_log(incremental=False, token_name="stub-token")
+        samples.append(time.perf_counter() - started)
+        pages = state.requests.get("/api/log/self", 0) - before
+    result = summarize(samples)
+    result.update({
+        "concurrency": concurrency,
+        "pages": pages,
+        "pages_per_second": round(pages / statistics.median(samples), 2),
+    })
+    return result
+
+
+def bench_memory(state: StubState) -> dict:
+    """
+    统计当天日志（含按模型统计）时的 Python 内存峰值，换算为每 1 万条日志
+    """
+    from aigc_api import session_manager
+    from log_stats import ModelBreakdown
+
+    aigc_api = session_manager.get()
+    aigc_api.ensure_login()
+    tracemalloc.start()
+    breakdown = ModelBreakdown()
+    aigc_api.get_dashboard_with_log(incremental=False, token_name="stub-token", breakdown=breakdown)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = max(len(state.logs), 1)
+    return {
+        "rows": rows,
+        "peak_bytes": peak,
+        "peak_bytes_per_10k_rows": int(peak * 10000 / rows),
+    }
+
+
+def bench_notify(state: StubState, messages: int) -> dict:
+    """
+    钉钉通知吞吐：同步发送和后台队列发送（不限流）每秒的消息数。
+    队列发送时积压的同类消息会合并为一次请求，另外记录实际发出的请求数和每秒请求数
+    """
+    from config import config
+    from DingTalkBot import DingTalkBot
+
+    dingtalk_conf = config.get_dingtalk()
+    webhook, secret = dingtalk_conf.get("webhook"), dingtalk_conf.get("secret")
+
+    bot = DingTalkBot(webhook, secret)
+    started = time.perf_counter()
+    for i in range(messages):
+        bot.send_text(f"bench {i}")
+    sync_elapsed = time.perf_counter() - started
+
+    queued_bot = DingTalkBot(f"{webhook}&queue=1", secret, asynchronous=True, rate_per_minute=10 ** 9)
+    before = state.requests.get("/robot/send", 0)
+    started = time.perf_counter()
+    futures = [queued_bot.send_text(f"bench {i}") for i in range(messages)]
+    submit_elapsed = time.perf_counter() - started
+    queued_bot.flush(timeout=60)
+    queued_elapsed = time.perf_counter() - started
+    queued_posts = state.requests.get("/robot/send", 0) - before
+    return {
+        "messages": messages,
+        "sync_messages_per_second": round(messages / sync_elapsed, 2),
+        "queued_submit_ms": round(submit_elapsed * 1000, 3),
+        "queued_messages_per_second": round(messages / queued_elapsed, 2),
+        "queued_posts": queued_posts,
+        "queued_posts_per_second": round(queued_posts / queued_elapsed, 2),
+        "queued_all_sent": all(future.result() for future in futures),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="turboai-notify 离线基准测试")
+    parser.add_argument("--rows", type=int, default=5000, help="当天的日志条数")
+    parser.add_argument("--latency-ms", type=float, default=10, help="模拟接口每个请求的延迟")
+    parser.add_argument("--max-page-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="并发拉取日志的页数")
+    parser.add_argument("--runs", type=int, default=5, help="每项测试的重复次数")
+    parser.add_argument("--messages", type=int, default=50, help="通知吞吐测试的消息数")
+    parser.add_argument("--output", default="bench_results.json", help="结果文件")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+
+    state = StubState(args.rows, args.latency_ms, args.max_page_size)
+    server = start_stub_server(state)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # 在临时目录中运行，配置、节假日文件和本地存储都不影响当前目录
+    work_dir = tempfile.mkdtemp(prefix="turboai-bench-")
+    os.chdir(work_dir)
+    with open("config.toml", "w", encoding="utf-8") as f:
+        f.write(CONFIG_TEMPLATE.format(base_url=base_url, concurrency=args.concurrency))
+    today = datetime.now()
+    with open(f"{today.year}.json", "w", encoding="utf-8") as f:
+        json.dump([{"date": today.strftime("%Y-%m-%d"), "holiday": False}], f)
+
+    results = {
+        "job": bench_job(state, args.runs),
+        "job_async": bench_job_async(state, args.runs),
+        "log_paging_sequential": bench_log_paging(state, args.runs, 1),
+        "log_paging_concurrent": bench_log_paging(state, args.runs, args.concurrency),
+        "memory": bench_memory(state),
+        "notify": bench_notify(state, args.messages),
+    }
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rows": args.rows,
+            "latency_ms": args.latency_ms,
+            "max_page_size": args.max_page_size,
+        },
+        "results": results,
+        "requests": state.requests,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    server.shutdown()
+    print(json.dumps(results, ensure_ascii=False, indent=4))
+    print(f"结果已写入 {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
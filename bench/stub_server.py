@@ -0,0 +1,175 @@
+"""
+本地模拟的 UniAPI 和钉钉机器人接口，用于离线基准测试
+
+    python bench/stub_server.py --rows 5000 --latency-ms 20 --port 18080
+"""
+
+import argparse
+import json
+import threading
+import time
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MODELS = ["gpt-4o", "gpt-4o-mini", "claude-3-5-sonnet", "deepseek-chat", "qwen-max"]
+
+
+class StubState:
+    """
+    模拟服务的数据和计数
+
+    Args:
+        rows: 今天的消费日志条数
+        latency_ms: 每个请求注入的延迟（毫秒）
+        max_page_size: 日志接口单页最大条数
+    """
+
+    def __init__(self, rows: int = 1000, latency_ms: float = 0, max_page_size: int = 100):
+        self.latency_ms = latency_ms
+        self.max_page_size = max_page_size
+        self.session_id = "stub-session"
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.set_rows(rows)
+
+    def set_rows(self, rows: int) -> None:
+        now = int(time.time())
+        day_start = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
+        # 日志按时间正序生成，均匀分布在最近 rows 秒内（不早于今天 00:00）
+        start = max(now - rows, day_start)
+        step = (now - start) / max(rows, 1)
+        self.logs = [
+            {
+                "id": i + 1,
+                "created_at": int(start + i * step),
+                "type": 2,
+                "token_name": "stub-token",
+                "model_name": MODELS[i % len(MODELS)],
+                "channel": i % 3,
+                "quota": 100 + i % 50,
+                "prompt_tokens": 100 + i % 100,
+                "completion_tokens": 50 + i % 30,
+                "use_time": 1 + i % 10,
+                "is_stream": bool(i % 2),
+            }
+            for i in range(rows)
+        ]
+        self.used_quota = sum(entry["quota"] for entry in self.logs)
+
+    def count(self, path: str) -> None:
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 响应头和响应体分两次写出，关闭 Nagle 避免每个请求多出约 40ms 的延迟确认等待
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, data, status=200, headers=None):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _prepare(self):
+            path = urlparse(self.path).path
+            state.count("/api/token/{id}" if path.startswith("/api/token/") else path)
+            if state.latency_ms:
+                time.sleep(state.latency_ms / 1000)
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length) if length else b""
+
+        def _logged(self):
+            return f"session={state.session_id}" in (self.headers.get("Cookie") or "")
+
+        def do_POST(self):
+            body = self._prepare()
+            path = urlparse(self.path).path
+            if path == "/api/user/login":
+                return self._send_json(
+                    {"success": True, "message": ""},
+                    headers={"Set-Cookie": f"session={state.session_id}; Path=/"},
+                )
+            if path == "/robot/send":
+                if len(body) > 20000:
+                    return self._send_json({"errcode": 460101, "errmsg": "message too long"})
+                return self._send_json({"errcode": 0, "errmsg": "ok"})
+            self._send_json({"success": False, "message": "not found"}, 404)
+
+        def do_GET(self):
+            self._prepare()
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path.startswith("/api/") and not self._logged():
+                return self._send_json({"success": False, "message": "未登录"}, 401)
+            if url.path.startswith("/api/token/"):
+                return self._send_json({
+                    "success": True,
+                    "data": {
+                        "id": url.path.rsplit("/", 1)[-1],
+                        "name": "stub-token",
+                        "key": "sk-stub0123456789abcdef",
+                        "remain_quota": 5000000,
+                        "used_quota": state.used_quota,
+                        "unlimited_quota": False,
+                    },
+                })
+            if url.path == "/api/user/dashboard":
+                return self._send_json({
+                    "success": True,
+                    "data": [{
+                        "Date": time.strftime("%Y-%m-%d"),
+                        "RequestCount": len(state.logs),
+                        "PromptTokens": sum(entry["prompt_tokens"] for entry in state.logs),
+                        "CompletionTokens": sum(entry["completion_tokens"] for entry in state.logs),
+                    }],
+                })
+            if url.path == "/api/log/self":
+                start = int(query.get("start_timestamp") or 0)
+                end = int(query.get("end_timestamp") or 2 ** 40)
+                page = int(query.get("page", 1))
+                size = min(int(query.get("size", 10)), state.max_page_size)
+                rows = [entry for entry in reversed(state.logs) if start <= entry["created_at"] <= end]
+                return self._send_json({
+                    "success": True,
+                    "data": {"data": rows[(page - 1) * size:page * size], "total_count": len(rows)},
+                })
+            self._send_json({"success": False, "message": "not found"}, 404)
+
+    return Handler
+
+
+def start_stub_server(state: StubState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    在后台线程中启动模拟服务，port 为 0 时使用随机端口
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的 UniAPI 和钉钉机器人接口")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--max-page-size", type=int, default=100)
+    args = parser.parse_args()
+    stub_server = start_stub_server(StubState(args.rows, args.latency_ms, args.max_page_size), port=args.port)
+    print(f"stub server listening on http://127.0.0.1:{stub_server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(10)
+    except KeyboardInterrupt:
+        stub_server.shutdown()
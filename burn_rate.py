@@ -0,0 +1,109 @@
+"""
+根据连续的额度快照估算消耗速度，预测额度耗尽时间并据此调整轮询间隔
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+
+class BurnRateEstimator:
+    """
+    消耗速度（quota/秒）的指数加权移动平均
+
+    快照间隔不固定，因此按时间衰减：两次快照间隔 dt 秒时权重为 1 - exp(-dt / half_life * ln2)。
+    只保留 window 秒内的快照，超过窗口没有新快照时重新开始估算。
+    """
+
+    def __init__(self, window: int = 6 * 3600, half_life: int = 3600):
+        self.window = window
+        self.half_life = half_life
+        self.samples = deque()  # (ts, used_quota)
+        self.rate: Optional[float] = None
+
+    def update(self, ts: int, used_quota: int) -> Optional[float]:
+        """
+        加入一条快照，返回更新后的消耗速度
+        """
+        if self.samples:
+            last_ts, last_used = self.samples[-1]
+            dt = ts - last_ts
+            if dt <= 0:
+                return self.rate
+            if dt > self.window:
+                self.samples.clear()
+                self.rate = None
+            else:
+                # used_quota 只增不减，变小说明令牌被重置，此时不计入消耗
+                instant_rate = max(used_quota - last_used, 0) / dt
+                if self.rate is None:
+                    self.rate = instant_rate
+                else:
+                    weight = 1 - math.exp(-dt / self.half_life * math.log(2))
+                    self.rate = weight * instant_rate + (1 - weight) * self.rate
+        self.samples.append((ts, used_quota))
+        while self.samples and self.samples[0][0] < ts - self.window:
+            self.samples.popleft()
+        return self.rate
+
+    def seconds_to_depletion(self, remain_quota: int) -> Optional[float]:
+        """
+        预计额度耗尽还需多少秒，没有消耗或数据不足时返回 None
+        """
+        if not self.rate or self.rate <= 0:
+            return None
+        return max(remain_quota, 0) / self.rate
+
+
+def next_poll_interval(seconds_left: Optional[float], min_interval: int = 300, max_interval: int = 4 * 3600,
+                       divisor: int = 10) -> int:
+    """
+    根据预计耗尽时间计算下一次轮询间隔：离耗尽越近轮询越频繁
+
+    Args:
+        seconds_left: 预计耗尽还需的秒数，None 表示没有消耗
+        min_interval: 最短间隔（秒）
+        max_interval: 最长间隔（秒）
+        divisor: 在耗尽之前至少轮询的次数
+
+    Returns:
+        间隔秒数
+    """
+    if seconds_left is None:
+        return max_interval
+    return int(min(max(seconds_left / divisor, min_interval), max_interval))
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes = seconds // 60
+    if days:
+        return f"{days}天{hours}小时"
+    if hours:
+        return f"{hours}小时{minutes}分钟"
+    return f"{minutes}分钟"
+
+
+_estimators = {}
+_estimators_lock = threading.Lock()
+
+
+def get_estimator(account: str, key_id: str, store=None, window: int = 6 * 3600,
+                  half_life: int = 3600) -> BurnRateEstimator:
+    """
+    获取令牌的进程内估算器，首次获取时用本地存储中窗口内的快照预热
+    """
+    key = (account, str(key_id))
+    with _estimators_lock:
+        estimator = _estimators.get(key)
+        if estimator is None:
+            estimator = BurnRateEstimator(window, half_life)
+            if store is not None:
+                for ts, _, used_quota in store.snapshots(account, key_id, int(time.time()) - window):
+                    estimator.update(ts, used_quota)
+            _estimators[key] = estimator
+        return estimator
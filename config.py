@@ -1,8 +1,16 @@
-import toml
-
 class Config:
     def __init__(self, filename="config.toml"):
-        self.config = toml.load(filename)
+        self.filename = filename
+        self._config = None
+
+    @property
+    def config(self):
+        # 首次读取配置时才解析文件，导入模块不产生文件读取
+        if self._config is None:
+            import toml
+
+            self._config = toml.load(self.filename)
+        return self._config
 
     def get(self, section, key=None, default=None):
         section_data = self.config.get(section, {})
@@ -17,9 +25,41 @@ class Config:
         active_dingtalk = self.active_dingtalk()
         return self.config.get(f'dingtalk-{active_dingtalk}', {})
 
+    def get_notifiers(self):
+        """
+        获取通知渠道列表 [[notifiers]]，未配置时使用 active_dingtalk 指定的钉钉机器人
+        """
+        notifiers = self.config.get('notifiers', [])
+        if not notifiers:
+            dingtalk = self.get_dingtalk()
+            return [{'type': 'dingtalk', 'name': f'dingtalk-{self.active_dingtalk()}',
+                     'webhook': dingtalk.get('webhook'), 'secret': dingtalk.get('secret')}]
+        return [{**notifier, 'name': notifier.get('name', f"{notifier.get('type', 'dingtalk')}-{index + 1}")}
+                for index, notifier in enumerate(notifiers)]
+
     def get_turboai(self):
         return self.config.get('turboai', {})
 
+    def get_accounts(self):
+        """
+        获取需要监控的账号列表，每个账号继承 [turboai] 中的默认配置。
+        未配置 [[accounts]] 时，使用 [turboai] 作为唯一账号，监控其 key_id。
+        """
+        turboai = self.get_turboai()
+        accounts = self.config.get('accounts', [])
+        if not accounts:
+            key_id = turboai.get('key_id')
+            return [{**turboai, 'name': turboai.get('name', 'default'), 'key_ids': [key_id] if key_id else []}]
+        result = []
+        for index, account in enumerate(accounts):
+            merged = {**turboai, **account}
+            merged.setdefault('name', f'account-{index + 1}')
+            if 'key_ids' not in account:
+                key_id = merged.get('key_id')
+                merged['key_ids'] = [key_id] if key_id else []
+            result.append(merged)
+        return result
+
 
 config = Config()
 
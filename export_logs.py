@@ -0,0 +1,86 @@
+"""
+按时间范围导出日志到 JSONL 或 CSV，逐页拉取逐行写出，内存占用与日志总量无关
+
+示例：
+    python export_logs.py 2024-07-01 2024-07-31 --format csv --output 2024-07.csv
+"""
+
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime, timedelta
+
+from aigc_api import session_manager
+from config import config
+from enums.log_type import LogType
+
+CSV_FIELDS = [
+    "id", "created_at", "type", "username", "token_name", "model_name", "channel",
+    "quota", "prompt_tokens", "completion_tokens", "use_time", "is_stream", "content",
+]
+
+
+def parse_day(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式应为 YYYY-MM-DD: {value}")
+
+
+def export_logs(aigc_api, start: datetime, end: datetime, output, fmt: str = "jsonl",
+                log_type: LogType = LogType.CONSUME, token_name: str = "") -> int:
+    """
+    将 [start, end) 内的日志写入 output
+
+    Returns:
+        导出的条数
+    """
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(output, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+    count = 0
+    # 接口的 end_timestamp 包含边界，减一秒使区间左闭右开
+    for entry in aigc_api.iter_logs(start, int(end.timestamp()) - 1, log_type=log_type, token_name=token_name):
+        if writer is not None:
+            writer.writerow(entry)
+        else:
+            output.write(json.dumps(entry, ensure_ascii=False))
+            output.write("\n")
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="导出 UniAPI 日志")
+    parser.add_argument("start", type=parse_day, help="开始日期（含），如 2024-07-01")
+    parser.add_argument("end", type=parse_day, help="结束日期（含），如 2024-07-31")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--output", help="输出文件，默认为标准输出")
+    parser.add_argument("--account", help="账号名称，默认为第一个账号")
+    parser.add_argument("--token-name", default="", help="令牌名称，默认导出所有令牌")
+    parser.add_argument("--log-type", choices=[log_type.name for log_type in LogType], default=LogType.CONSUME.name)
+    args = parser.parse_args(argv)
+
+    accounts = config.get_accounts()
+    if args.account:
+        accounts = [account for account in accounts if account.get("name") == args.account]
+        if not accounts:
+            parser.error(f"未找到账号: {args.account}")
+    aigc_api = session_manager.get(accounts[0])
+
+    output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        count = export_logs(
+            aigc_api, args.start, args.end + timedelta(days=1), output, args.format,
+            LogType[args.log_type], args.token_name,
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"共导出 {count} 条日志", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,16 @@
 节假日相关的工具方法
 """
 
-from datetime import datetime
+from datetime import date as Date, datetime, timedelta
 import json
 import logging
 import os
-import requests
+import threading
+import time
 from typing import Optional
 
+from metrics import time_request
+
 
 def fetch_holiday(year: Optional[int] = None) -> Optional[list[dict]]:
     """
@@ -32,13 +35,20 @@ def fetch_holiday(year: Optional[int] = None) -> Optional[list[dict]]:
         ]
     """
 
+    # 只有本地没有节假日文件时才需要请求，按需导入 requests
+    import requests
+
+    from http_client import get_transport
+
     year = datetime.now().year if year is None else year
 
     url = f"https://date.appworlds.cn/year/{year}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        rj = response.json()
+        with time_request("holiday", "/year/{year}") as timing:
+            response = get_transport().request("GET", url, timeout=10, service="holiday")
+            timing["status"] = str(response.status_code)
+            response.raise_for_status()
+            rj = response.json()
         if rj.get("code") != 200:
             logging.error(f"获取节假日信息失败, msg: {rj.get('msg')}")
             return None
@@ -48,6 +58,10 @@ def fetch_holiday(year: Optional[int] = None) -> Optional[list[dict]]:
         return None
 
 
+def holiday_filename(year: int) -> str:
+    return f"{year}.json"
+
+
 def save_holiday(holiday_info: list[dict], year: int) -> None:
     """
     保存节假日信息到本地文件
@@ -56,7 +70,7 @@ def save_holiday(holiday_info: list[dict], year: int) -> None:
         holiday_info: 节假日信息列表
         year: 年份
     """
-    filename = f"{year}.json"
+    filename = holiday_filename(year)
 
     try:
         with open(filename, "w", encoding="utf-8") as f:
@@ -66,33 +80,156 @@ def save_holiday(holiday_info: list[dict], year: int) -> None:
         logging.error(f"保存节假日信息失败: {e}")
 
 
-def load_or_fetch_holiday_info(year: int) -> list[dict]:
+class HolidayCalendar:
     """
-    加载或获取指定年份的节假日信息
+    进程内的节假日日历索引
 
-    Args:
-        year: 年份
-
-    Returns:
-        节假日信息列表，如果获取失败则返回None
+    每年的数据只加载一次，并预先计算为按年内天数索引的工作日位图，查询为 O(1)。
+    本地文件修改时间变化后重新加载；远程获取失败时在 negative_ttl 秒内不再重试，
+    期间按常规周末判断。12 月时在后台预取下一年的数据。
     """
-    filename = f"{year}.json"
 
-    if os.path.exists(filename):
+    def __init__(self, negative_ttl: int = 3600):
+        self.negative_ttl = negative_ttl
+        # year -> (文件修改时间, 工作日位图)
+        self._years: dict[int, tuple[Optional[float], bytearray]] = {}
+        # year -> 获取失败结果的过期时间
+        self._failed_until: dict[int, float] = {}
+        self._prefetching: set[int] = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build_bitmap(year: int, holiday_info: list[dict]) -> bytearray:
+        """
+        生成一年的工作日位图，下标为年内第几天（从 0 开始），1 表示工作日
+        """
+        first_day = Date(year, 1, 1)
+        days = (Date(year + 1, 1, 1) - first_day).days
+        bitmap = bytearray(
+            1 if (first_day + timedelta(days=i)).weekday() < 5 else 0 for i in range(days)
+        )
+        for info in holiday_info:
+            try:
+                day = datetime.strptime(info.get("date", ""), "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            if day.year == year:
+                bitmap[day.timetuple().tm_yday - 1] = 0 if info.get("holiday", False) else 1
+        return bitmap
+
+    @staticmethod
+    def _read_file(filename: str) -> Optional[list[dict]]:
         try:
             with open(filename, "r", encoding="utf-8") as f:
-                holiday_info = json.load(f)
-            if holiday_info:
-                return holiday_info
+                return json.load(f)
         except (IOError, json.JSONDecodeError) as e:
             logging.warning(f"读取本地节假日信息失败: {e}")
+            return None
+
+    def _file_mtime(self, year: int) -> Optional[float]:
+        try:
+            return os.path.getmtime(holiday_filename(year))
+        except OSError:
+            return None
 
-    holiday_info = fetch_holiday(year)
-    if holiday_info is None or not holiday_info:
-        logging.warning(f"无法获取{year}年的节假日信息，将使用默认周末判断")
-        return []
-    save_holiday(holiday_info, year)
-    return holiday_info
+    def _cached(self, year: int, mtime: Optional[float]) -> Optional[bytearray]:
+        """
+        文件未变化时返回已加载的位图；远程获取失败的年份在 negative_ttl 内同样沿用，过期后重新获取
+        """
+        cached = self._years.get(year)
+        if cached is None or cached[0] != mtime:
+            return None
+        if year in self._failed_until and time.time() >= self._failed_until[year]:
+            return None
+        return cached[1]
+
+    def _load_year(self, year: int) -> bytearray:
+        mtime = self._file_mtime(year)
+        bitmap = self._cached(year, mtime)
+        if bitmap is not None:
+            return bitmap
+
+        with self._lock:
+            # 加锁后再检查一次，避免多个线程重复加载
+            bitmap = self._cached(year, mtime)
+            if bitmap is not None:
+                return bitmap
+
+            holiday_info = self._read_file(holiday_filename(year)) if mtime is not None else None
+            if holiday_info:
+                self._failed_until.pop(year, None)
+            elif time.time() < self._failed_until.get(year, 0):
+                # 本地文件有变化但仍不可用，失败缓存未过期时不请求远程
+                holiday_info = []
+            else:
+                holiday_info = fetch_holiday(year)
+                if holiday_info:
+                    save_holiday(holiday_info, year)
+                    self._failed_until.pop(year, None)
+                else:
+                    logging.warning(
+                        f"无法获取{year}年的节假日信息，将使用默认周末判断，{self.negative_ttl}秒后重试"
+                    )
+                    self._failed_until[year] = time.time() + self.negative_ttl
+                    holiday_info = []
+            # 记录文件的实际修改时间（包括空文件、损坏的文件或保存失败时的旧文件），文件不变时不再重复读取
+            bitmap = self._build_bitmap(year, holiday_info)
+            self._years[year] = (self._file_mtime(year), bitmap)
+            return bitmap
+
+    def _prefetch(self, year: int) -> None:
+        with self._lock:
+            if year in self._prefetching or year in self._years:
+                return
+            self._prefetching.add(year)
+
+        def run():
+            try:
+                self._load_year(year)
+            finally:
+                with self._lock:
+                    self._prefetching.discard(year)
+
+        threading.Thread(target=run, name=f"holiday-prefetch-{year}", daemon=True).start()
+
+    def is_workday(self, day: Date) -> bool:
+        today = datetime.now().date()
+        if today.month == 12:
+            self._prefetch(today.year + 1)
+        return self._load_year(day.year)[day.timetuple().tm_yday - 1] == 1
+
+    def next_workdays(self, n: int, start: Optional[Date] = None) -> list[Date]:
+        """
+        获取从 start（含）开始的 n 个工作日
+        """
+        day = datetime.now().date() if start is None else start
+        result = []
+        while len(result) < n:
+            bitmap = self._load_year(day.year)
+            index = day.timetuple().tm_yday - 1
+            while index < len(bitmap) and len(result) < n:
+                if bitmap[index]:
+                    result.append(day)
+                day += timedelta(days=1)
+                index += 1
+        return result
+
+    def count_workdays(self, start: Date, end: Date) -> int:
+        """
+        统计 [start, end] 区间内的工作日数
+        """
+        count = 0
+        day = start
+        while day <= end:
+            bitmap = self._load_year(day.year)
+            first = day.timetuple().tm_yday - 1
+            last = (end.timetuple().tm_yday - 1) if end.year == day.year else len(bitmap) - 1
+            count += sum(bitmap[first:last + 1])
+            day = Date(day.year + 1, 1, 1)
+        return count
+
+
+holiday_calendar = HolidayCalendar()
 
 
 def is_workday(date: Optional[str] = None) -> bool:
@@ -107,17 +244,7 @@ def is_workday(date: Optional[str] = None) -> bool:
         False: 不是工作日
     """
     date = datetime.now() if date is None else datetime.strptime(date, "%Y-%m-%d")
-
-    year = date.year
-    holiday_info = load_or_fetch_holiday_info(year)
-
-    date_str = date.strftime("%Y-%m-%d")
-    for info in holiday_info:
-        if info.get("date") == date_str:
-            return not info.get("holiday", False)
-
-    # 如果没有特殊节假日信息，则按照常规工作日判断
-    return date.weekday() < 5
+    return holiday_calendar.is_workday(date.date())
 
 
 if __name__ == "__main__":
@@ -127,3 +254,4 @@ if __name__ == "__main__":
     print(f"2024-10-04 是否工作日：{is_workday('2024-10-04')}")
     print(f"2024-10-05 是否工作日：{is_workday('2024-10-05')}")
     print(f"2024-10-12 是否工作日：{is_workday('2024-10-12')}")
+    print(f"接下来 5 个工作日：{holiday_calendar.next_workdays(5)}")
@@ -0,0 +1,236 @@
+"""
+所有外部 HTTP 请求共用的传输层：按 host 复用连接池、连接/读取超时、
+带抖动的指数退避重试（遵循 Retry-After）以及按 host 的熔断
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import HTTP_RETRIES
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    目标 host 处于熔断状态，请求未发出
+    """
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后熔断 reset_timeout 秒，
+    之后放行一个试探请求，成功则恢复，失败则继续熔断
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头，支持秒数和 HTTP 日期两种格式
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class HttpTransport:
+    """
+    Args:
+        connect_timeout: 建立连接超时（秒）
+        read_timeout: 读取响应超时（秒）
+        max_retries: 最多重试次数
+        backoff_base: 退避基数（秒），第 n 次重试最多等待 backoff_base * 2^n
+        backoff_max: 单次退避的上限（秒），Retry-After 也不会超过该值
+        pool_maxsize: 每个 host 保持的最大连接数
+        failure_threshold: 连续失败多少次后熔断
+        reset_timeout: 熔断持续时间（秒）
+    """
+
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 30, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 30, pool_maxsize: int = 10,
+                 failure_threshold: int = 5, reset_timeout: float = 60):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # 同一个 adapter 挂载到所有 session 上，连接池按 host 在它们之间共享
+        self.adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize)
+        self.session = self.new_session()
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def new_session(self) -> requests.Session:
+        """
+        创建使用共享连接池的 session，用于需要独立 cookie 的场景（如每个账号的登录会话）
+        """
+        session = requests.Session()
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        return session
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        第 attempt 次重试前的等待时间：full jitter 指数退避，有 Retry-After 时取两者较大值
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    @staticmethod
+    def _before(deadline: Optional[float], delay: float) -> bool:
+        """退避 delay 秒后是否仍在截止时间之前"""
+        return deadline is None or time.monotonic() + delay < deadline
+
+    def request(self, method: str, url: str, session: Optional[requests.Session] = None,
+                retry: Optional[bool] = None, max_retries: Optional[int] = None, deadline: Optional[float] = None,
+                service: str = "other", **kwargs) -> requests.Response:
+        """
+        发送请求。连接失败、超时以及 429/5xx 响应会退避后重试，重试用尽后返回最后一次响应或抛出异常
+
+        Args:
+            method: 请求方法
+            url: 请求地址
+            session: 使用的 session，默认为共享 session
+            retry: 是否重试，默认只重试 GET 请求
+            max_retries: 覆盖默认的最多重试次数
+            deadline: 截止时间（time.monotonic()），包括重试和退避在内不超过该时间，超时抛出 requests.Timeout
+            service: 服务名称（如 uniapi、dingtalk），作为重试指标的标签，与 time_request 的 service 一致
+            kwargs: 传给 requests 的其他参数，未指定 timeout 时使用默认超时
+        """
+        session = self.session if session is None else session
+        kwargs.setdefault("timeout", self.timeout)
+        retry = method.upper() == "GET" if retry is None else retry
+        max_retries = (self.max_retries if max_retries is None else max_retries) if retry else 0
+        host = urlparse(url).netloc
+        breaker = self.breaker(host)
+
+        timeout = kwargs["timeout"]
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(f"{host} 连续请求失败，已熔断")
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.Timeout(f"请求 {host} 超出截止时间")
+                connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+                kwargs["timeout"] = tuple(remaining if value is None else min(value, remaining)
+                                          for value in (connect_timeout, read_timeout))
+            retry_after = None
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                delay = self.backoff(attempt, retry_after)
+                if attempt >= max_retries or not self._before(deadline, delay):
+                    raise
+                logging.warning(f"请求 {host} 失败: {e}")
+            except Exception:
+                breaker.record_failure()
+                raise
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                delay = self.backoff(attempt, retry_after)
+                if not self._before(deadline, delay):
+                    return response
+                logging.warning(f"请求 {host} 返回 {response.status_code}")
+                response.close()
+            attempt += 1
+            HTTP_RETRIES.inc(service=service)
+            logging.warning(f"{delay:.2f} 秒后重试 ({attempt}/{max_retries})")
+            time.sleep(delay)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """
+    获取进程内共享的传输层，参数来自配置 [http]
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            from config import config
+
+            # 连接池不小于同时发往同一 host 的请求数，否则多出的连接用完即被丢弃
+            pool_maxsize = max(
+                config.get("http", "pool_maxsize", 10),
+                int(config.get("turboai", "log_concurrency", 1)),
+                int(config.get("turboai", "max_workers", 8)),
+            )
+            _transport = HttpTransport(
+                connect_timeout=config.get("http", "connect_timeout", 5),
+                read_timeout=config.get("http", "read_timeout", 30),
+                max_retries=config.get("http", "max_retries", 3),
+                backoff_base=config.get("http", "backoff_base", 0.5),
+                backoff_max=config.get("http", "backoff_max", 30),
+                pool_maxsize=pool_maxsize,
+                failure_threshold=config.get("http", "failure_threshold", 5),
+                reset_timeout=config.get("http", "reset_timeout", 60),
+            )
+        return _transport
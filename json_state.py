@@ -0,0 +1,46 @@
+"""
+本地 JSON 状态文件（日志游标、会话 cookie、通知状态、异常检测状态）的读写
+"""
+
+import json
+import logging
+import os
+from typing import Optional
+
+
+def load_json(path: str, label: str) -> dict:
+    """
+    读取状态文件，文件不存在或损坏时返回空字典
+
+    Args:
+        path: 文件路径
+        label: 日志中的状态名称，如 "通知状态"
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        logging.warning(f"读取{label}失败: {e}")
+        return {}
+
+
+def save_json(path: str, data: dict, label: str, mode: Optional[int] = None) -> None:
+    """
+    保存状态文件，先写临时文件再替换，避免中断时损坏
+
+    Args:
+        path: 文件路径
+        data: 状态
+        label: 日志中的状态名称
+        mode: 新文件的权限，如 0o600 表示仅当前用户可读写，默认按 umask
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except IOError as e:
+        logging.error(f"保存{label}失败: {e}")
@@ -0,0 +1,143 @@
+"""
+日志增量统计的游标（高水位）持久化
+"""
+
+import logging
+import threading
+from typing import Optional
+
+from json_state import load_json, save_json
+from log_stats import ModelBreakdown
+
+# 多个令牌可能在不同线程中同时写同一个游标文件
+_file_lock = threading.Lock()
+
+
+class LogCursor:
+    """
+    记录某个令牌当天已统计过的日志位置和累计值
+
+    last_created_at 为已统计的最新一条日志的时间戳，boundary_ids 为该秒内已统计过的日志 id，
+    用于在下一次从 last_created_at 开始拉取时去重。
+    """
+
+    def __init__(self, key: str, day_start: int = 0, by_channel: bool = False):
+        self.key = key
+        self.by_channel = by_channel
+        self.reset(day_start)
+
+    def reset(self, day_start: int) -> None:
+        self.day_start = day_start
+        self.last_created_at = 0
+        self.boundary_ids = []
+        self.request_count = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.quota = 0
+        self.models = ModelBreakdown(self.by_channel)
+
+    def is_seen(self, entry: dict) -> bool:
+        """
+        判断日志是否已经统计过
+        """
+        created_at = entry.get("created_at", 0)
+        if created_at != self.last_created_at:
+            return created_at < self.last_created_at
+        return entry.get("id") in self.boundary_ids
+
+    def collect_new(self, pages) -> tuple[list[dict], int]:
+        """
+        从按时间倒序的日志页中取出未统计过的日志。同一秒内的日志顺序不固定，
+        已统计的 id 之后仍可能有新日志，因此只在出现早于高水位的日志后才停止拉取
+
+        Returns:
+            (新日志（倒序）, 拉取的页数)
+        """
+        new_entries = []
+        page_count = 0
+        for data in pages:
+            page_count += 1
+            new_entries.extend(entry for entry in data if not self.is_seen(entry))
+            if any(entry.get("created_at", 0) < self.last_created_at for entry in data):
+                break
+        return new_entries, page_count
+
+    def add(self, entry: dict) -> None:
+        """
+        累加一条新日志并推进高水位
+        """
+        self.request_count += 1
+        self.prompt_tokens += entry["prompt_tokens"]
+        self.completion_tokens += entry["completion_tokens"]
+        self.quota += entry["quota"]
+        self.models.add(entry)
+        created_at = entry.get("created_at", 0)
+        if created_at > self.last_created_at:
+            self.last_created_at = created_at
+            self.boundary_ids = [entry.get("id")]
+        elif created_at == self.last_created_at:
+            self.boundary_ids.append(entry.get("id"))
+
+    def to_dict(self) -> dict:
+        return {
+            "day_start": self.day_start,
+            "last_created_at": self.last_created_at,
+            "boundary_ids": self.boundary_ids,
+            "request_count": self.request_count,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "quota": self.quota,
+            "models": self.models.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, key: str, data: dict) -> "LogCursor":
+        models = ModelBreakdown.from_dict(data.get("models", {}))
+        cursor = cls(key, data.get("day_start", 0), models.by_channel)
+        cursor.last_created_at = data.get("last_created_at", 0)
+        cursor.boundary_ids = data.get("boundary_ids", [])
+        cursor.request_count = data.get("request_count", 0)
+        cursor.prompt_tokens = data.get("prompt_tokens", 0)
+        cursor.completion_tokens = data.get("completion_tokens", 0)
+        cursor.quota = data.get("quota", 0)
+        cursor.models = models
+        return cursor
+
+
+def load_cursor(filename: str, key: str, day_start: int, by_channel: Optional[bool] = None) -> LogCursor:
+    """
+    加载指定令牌的游标，跨天时自动重置
+
+    Args:
+        filename: 游标文件路径
+        key: 游标键，一般为 host + 令牌名称
+        day_start: 当天 00:00 的时间戳
+        by_channel: 模型统计是否按渠道区分，与已保存的不一致时重新统计，None 表示不限
+
+    Returns:
+        LogCursor
+    """
+    with _file_lock:
+        data = load_json(filename, "日志游标").get(key)
+    if not data:
+        return LogCursor(key, day_start, bool(by_channel))
+    cursor = LogCursor.from_dict(key, data)
+    if cursor.day_start != day_start:
+        logging.info(f"日志游标 {key} 已跨天，重置统计")
+        cursor.reset(day_start)
+    if ("latency" not in data.get("models", {})
+            or (by_channel is not None and cursor.by_channel != by_channel)):
+        # 旧版本的游标没有模型统计或分位数草图，或统计维度变化，需要重新统计当天的日志
+        cursor.by_channel = bool(by_channel)
+        cursor.reset(day_start)
+    return cursor
+
+
+def save_cursor(filename: str, cursor: LogCursor) -> None:
+    """
+    保存游标，先写临时文件再替换，避免中断时损坏
+    """
+    with _file_lock:
+        all_data = load_json(filename, "日志游标")
+        all_data[cursor.key] = cursor.to_dict()
+        save_json(filename, all_data, "日志游标")
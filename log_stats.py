@@ -0,0 +1,225 @@
+"""
+消费日志的流式聚合统计
+"""
+
+import math
+from array import array
+from typing import Optional
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class QuantileSketch:
+    """
+    可合并的流式分位数草图（对数分桶，同 DDSketch）
+
+    正数按 gamma 的对数分桶，每个桶只保存计数，分位数的相对误差不超过 relative_accuracy；
+    两个草图合并即桶计数相加，可以跨页、跨天、跨进程合并而不保留原始数据。
+    桶数超过 max_bins 时合并最小的桶，只影响最低端的分位数。
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value: float, weight: int = 1) -> None:
+        if value is None:
+            return
+        if value <= 0:
+            self.zero_count += weight
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + weight
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        self.count += weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _collapse(self) -> None:
+        lowest, second = sorted(self.bins)[:2]
+        self.bins[second] += self.bins.pop(lowest)
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("relative_accuracy 不同的草图不能合并")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        返回 q 分位数（0 <= q <= 1）的近似值，没有数据时返回 None
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return max(self.min, 0)
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def quantiles(self, qs=QUANTILES) -> list[Optional[float]]:
+        return [self.quantile(q) for q in qs]
+
+    def to_dict(self) -> dict:
+        indexes = sorted(self.bins)
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "indexes": indexes,
+            "counts": [self.bins[index] for index in indexes],
+            "zero_count": self.zero_count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data.get("relative_accuracy", 0.01))
+        sketch.bins = dict(zip(data.get("indexes", []), data.get("counts", [])))
+        sketch.zero_count = data.get("zero_count", 0)
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        if sketch.count:
+            sketch.min = data.get("min", 0)
+            sketch.max = data.get("max", 0)
+        return sketch
+
+
+class ModelBreakdown:
+    """
+    按模型（可选再按渠道）聚合请求数、token 和 quota
+
+    每个模型分配一个下标，统计值按列保存在 array 中，每条日志只需一次字典查找和几次数组累加，
+    不保留日志本身。每个模型另有请求耗时（use_time）和单次请求 token 数的分位数草图。
+    """
+
+    FIELDS = ("counts", "prompt_tokens", "completion_tokens", "quota")
+    SKETCHES = ("latency", "tokens")
+
+    def __init__(self, by_channel: bool = False):
+        self.by_channel = by_channel
+        self.index: dict[str, int] = {}
+        self.keys: list[str] = []
+        self.counts = array("q")
+        self.prompt_tokens = array("q")
+        self.completion_tokens = array("q")
+        self.quota = array("q")
+        self.latency: list[QuantileSketch] = []
+        self.tokens: list[QuantileSketch] = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _slot(self, key: str) -> int:
+        slot = self.index.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            self.index[key] = slot
+            self.keys.append(key)
+            for field in self.FIELDS:
+                getattr(self, field).append(0)
+            for field in self.SKETCHES:
+                getattr(self, field).append(QuantileSketch())
+        return slot
+
+    def key_of(self, entry: dict) -> str:
+        model_name = entry.get("model_name") or "unknown"
+        if self.by_channel:
+            return f"{model_name}@{entry.get('channel', '')}"
+        return model_name
+
+    def add(self, entry: dict) -> int:
+        """
+        累加一条日志，返回该日志所属的下标
+        """
+        slot = self._slot(self.key_of(entry))
+        prompt_tokens = entry.get("prompt_tokens", 0)
+        completion_tokens = entry.get("completion_tokens", 0)
+        self.counts[slot] += 1
+        self.prompt_tokens[slot] += prompt_tokens
+        self.completion_tokens[slot] += completion_tokens
+        self.quota[slot] += entry.get("quota", 0)
+        self.latency[slot].add(entry.get("use_time"))
+        self.tokens[slot].add(prompt_tokens + completion_tokens)
+        return slot
+
+    def add_page(self, entries: list[dict]) -> None:
+        for entry in entries:
+            self.add(entry)
+
+    def merge(self, other: "ModelBreakdown") -> "ModelBreakdown":
+        """
+        合并另一份统计（如其他页、其他天或其他进程的统计）
+        """
+        for other_slot, key in enumerate(other.keys):
+            slot = self._slot(key)
+            for field in self.FIELDS:
+                getattr(self, field)[slot] += getattr(other, field)[other_slot]
+            for field in self.SKETCHES:
+                getattr(self, field)[slot].merge(getattr(other, field)[other_slot])
+        return self
+
+    def top(self, n: Optional[int] = None, by: str = "quota") -> list[dict]:
+        """
+        按指定字段从大到小返回前 n 个模型的统计，latency 和 tokens 为 p50/p95/p99
+        """
+        values = getattr(self, by)
+        slots = sorted(range(len(self.keys)), key=values.__getitem__, reverse=True)
+        if n is not None:
+            slots = slots[:n]
+        return [
+            {
+                "model": self.keys[slot],
+                "count": self.counts[slot],
+                "prompt_tokens": self.prompt_tokens[slot],
+                "completion_tokens": self.completion_tokens[slot],
+                "quota": self.quota[slot],
+                "latency": self.latency[slot].quantiles(),
+                "tokens": self.tokens[slot].quantiles(),
+            }
+            for slot in slots
+        ]
+
+    def to_dict(self) -> dict:
+        data = {"by_channel": self.by_channel, "keys": self.keys}
+        for field in self.FIELDS:
+            data[field] = getattr(self, field).tolist()
+        for field in self.SKETCHES:
+            data[field] = [sketch.to_dict() for sketch in getattr(self, field)]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ModelBreakdown":
+        breakdown = cls(data.get("by_channel", False))
+        breakdown.keys = list(data.get("keys", []))
+        breakdown.index = {key: slot for slot, key in enumerate(breakdown.keys)}
+        for field in cls.FIELDS:
+            setattr(breakdown, field, array("q", data.get(field, [0] * len(breakdown.keys))))
+        for field in cls.SKETCHES:
+            sketches = [QuantileSketch.from_dict(item) for item in data.get(field, [])]
+            sketches += [QuantileSketch() for _ in range(len(breakdown.keys) - len(sketches))]
+            setattr(breakdown, field, sketches)
+        return breakdown
@@ -1,15 +1,39 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from urllib.parse import quote, urljoin
 import time
+
+STARTED_AT = time.perf_counter()
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import quote, urljoin
+import argparse
 import logging
+import sys
+import threading
 
-from DingTalkBot import DingTalkBot
-from aigc_api import AigcApi
+from aigc_api import session_manager
+from anomaly import run_anomaly_check
+from burn_rate import format_duration, get_estimator, next_poll_interval
 from config import config
 from holiday import is_workday
+from log_stats import ModelBreakdown
+from metrics import JOB_LAG, JOB_PARTIAL, JOB_SKIPPED, start_metrics_server, time_job
+from notifier import get_notifier
+from notify_policy import get_notification_policy
+from query_api import publish_balance, publish_today, start_query_server
+from quota_store import get_quota_store
+from today_stats import get_today_stats_provider
+
+JOB_ID = "aigc"
+ANOMALY_JOB_ID = "anomaly"
+IMPORTED_AT = time.perf_counter()
 
 
-def setup_logging():
+def setup_logging(mode="w"):
+    """
+    Args:
+        mode: 日志文件打开方式，单次运行（--once）时使用 "a" 追加，保留之前各次运行的日志
+    """
     log_level = config.get("logging", "level", "DEBUG")
     log_path = config.get("logging", "path", "app.log")
 
@@ -21,7 +45,7 @@ def setup_logging():
     logger.setLevel(log_level)
 
     # Create file handler
-    file_handler = logging.FileHandler(log_path, mode="w", encoding="utf-8")
+    file_handler = logging.FileHandler(log_path, mode=mode, encoding="utf-8")
     file_handler.setLevel(log_level)
     file_formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s"
@@ -39,119 +63,788 @@ def setup_logging():
     logger.addHandler(console_handler)
 
 
-def do_job_aigc(scheduler=None):
-    if not is_workday():
-        logging.info("今天不是工作日，不执行任务")
-        return
-    dingtalk_conf = config.get_dingtalk()
-    webhook = dingtalk_conf.get("webhook")
-    secret = dingtalk_conf.get("secret")
-    bot = DingTalkBot(webhook, secret)
-    aigc_api = AigcApi()
-    login = aigc_api.login()
-    if not login:
-        bot.send_text("UniAPI登录失败")
-        return
-    token_data = aigc_api.get_token()
+# 令牌 id 到名称的缓存，异步任务据此在查询令牌的同时拉取今日日志
+_token_names = {}
+
+
+def summarize_token(aigc_api, key_id, token_data, policy=None):
+    """
+    根据令牌查询结果生成报告的基础部分（额度和预计可用时间），并判断是否需要通知
+
+    Returns:
+        报告字典，包含 text（报告文本）、credit（剩余额度，查询失败时为 None）、
+        seconds_left（预计额度耗尽还需的秒数，无法预测时为 None）、notify_reason（需要通知的原因，无需通知时为 None）
+    """
+    account = aigc_api.turboai
+    report_key = f"{account.get('name')}/{key_id}"
+    report = {
+        "key": report_key,
+        "key_id": key_id,
+        "account": account.get("name"),
+        "host": aigc_api.host_url,
+        "credit": None,
+        "low_credit": False,
+        "seconds_left": None,
+        "burn_rate": None,
+    }
     success_token = bool(token_data.get("success"))
-    one_yuan_units = config.get("turboai", "units", 500000)
-    text = ""
-    action_card_btns = []
-    if success_token:
-        data = token_data.get("data")
-        name = data.get("name")
-        used_quota = data.get("used_quota")
-        unlimited_quota = data.get("unlimited_quota")
-        remain_quota = data.get("remain_quota")
-        credit = remain_quota / one_yuan_units
-        credit = round(credit, 2)
-        used_credit = used_quota / one_yuan_units
-        used_credit = round(used_credit, 2)
-        key = data.get("key")
-        masked_key = key[:3] + "*" * 5 + key[-5:]
-        text += f"**令牌名称:** {name}  \n  **令牌密钥:** {masked_key}"
-        currency = config.get("turboai", "currency", "¥")
-        if unlimited_quota:
-            text += (
-                f"  \n  **剩余额度:** 无限制  \n  **已用额度:** {currency}{used_credit}"
-            )
-        else:
-            text += f"  \n  **剩余额度:** **{currency}{credit}**  \n  **已用额度:** {currency}{used_credit}"
+    if not success_token:
+        msg = token_data.get("message")
+        report["text"] = f"UniAPI余额查询失败({report_key}), msg: {msg}"
+        report["notify_reason"] = policy.check(report_key, None) if policy else "查询失败"
+        return report
+
+    one_yuan_units = account.get("units", 500000)
+    data = token_data.get("data")
+    name = data.get("name")
+    _token_names[report_key] = name
+    publish_balance(aigc_api, key_id, data)
+    used_quota = data.get("used_quota")
+    unlimited_quota = data.get("unlimited_quota")
+    remain_quota = data.get("remain_quota")
+    credit = remain_quota / one_yuan_units
+    credit = round(credit, 2)
+    used_credit = used_quota / one_yuan_units
+    used_credit = round(used_credit, 2)
+    key = data.get("key")
+    masked_key = key[:3] + "*" * 5 + key[-5:]
+    text = f"**令牌名称:** {name}  \n  **令牌密钥:** {masked_key}"
+    currency = account.get("currency", "¥")
+    if unlimited_quota:
+        text += (
+            f"  \n  **剩余额度:** 无限制  \n  **已用额度:** {currency}{used_credit}"
+        )
+    else:
+        text += f"  \n  **剩余额度:** **{currency}{credit}**  \n  **已用额度:** {currency}{used_credit}"
+
+    seconds_left = burn_rate = None
+    if not unlimited_quota:
+        estimator = get_estimator(
+            account.get("name"), key_id, get_quota_store(),
+            window=config.get("schedule", "burn_rate_window", 6 * 3600),
+            half_life=config.get("schedule", "burn_rate_half_life", 3600),
+        )
+        burn_rate = estimator.update(int(time.time()), used_quota)
+        seconds_left = estimator.seconds_to_depletion(remain_quota)
+        if seconds_left is not None:
+            text += f"  \n  预计可用: 约{format_duration(seconds_left)}"
+
+    report.update({
+        "text": text,
+        "name": name,
+        "remain_quota": remain_quota,
+        "used_quota": used_quota,
+        "unlimited_quota": unlimited_quota,
+        "credit": credit,
+        "seconds_left": seconds_left,
+        "burn_rate": burn_rate,
+        "notify_reason": policy.check(report_key, credit, burn_rate) if policy else "定时通知",
+    })
+    return report
 
-        if 16 <= time.localtime().tm_hour <= 19:
+
+def in_today_hours():
+    start_hour, end_hour = config.get("report", "today_hours", [16, 19])
+    return start_hour <= time.localtime().tm_hour <= end_hour
+
+
+def wants_today(report, policy=None):
+    """
+    是否需要在报告中附带今日消费。无需通知时跳过今日日志的分页拉取（开启 on_change 时仍需完整报告来比较内容）
+    """
+    if report["credit"] is None or not in_today_hours():
+        return False
+    return report["notify_reason"] is not None or (policy is not None and policy.on_change)
+
+
+def fetch_today(aigc_api, key_id, token_name, deadline=None):
+    """
+    获取今日统计并生成今日消费部分的报告，数据来源见 today_stats
+
+    Args:
+        deadline: 截止时间（time.monotonic()），到达后停止拉取日志，今日统计只包含已拉取的部分
+
+    Returns:
+        (报告文本, 今日请求数, 今日消费, 今日统计)
+    """
+    account = aigc_api.turboai
+    one_yuan_units = account.get("units", 500000)
+    currency = account.get("currency", "¥")
+    breakdown = ModelBreakdown(config.get("report", "by_channel", False))
+    stats = get_today_stats_provider().fetch(aigc_api, key_id, token_name, breakdown, deadline=deadline)
+    today_request_count, today_cost = stats["request_count"], stats["cost"]
+    text = f"  \n"
+    if stats["partial"]:
+        text += "  \n  *今日日志未能在本次时间预算内拉取完，以下为部分统计*"
+    else:
+        publish_today(aigc_api, key_id, token_name, today_request_count, today_cost, stats["total_tokens"],
+                      stats["source"])
+    if today_cost is not None:
+        text += f"  \n  今日消费: {currency}{today_cost}"
+        if stats["cost_at"] is not None and time.time() - stats["cost_at"] >= 60:
+            text += f"（截至 {time.strftime('%H:%M', time.localtime(stats['cost_at']))}）"
+    text += f"  \n  今日请求: {today_request_count}次"
+    text += f"  \n  今日Token: {stats['total_tokens']}"
+    text += format_top_models(breakdown, one_yuan_units, currency)
+    return text, today_request_count, today_cost, stats
+
+
+def finish_token_report(report, policy=None, today=None):
+    """
+    合并今日消费部分，保存额度快照，补充余额提醒
+    """
+    if report["credit"] is None:
+        return report
+    today_text, today_request_count, today_cost, today_stats = today if today is not None else ("",) + (None,) * 3
+    report["text"] += today_text
+    if today_stats is not None:
+        report["today_source"] = today_stats["source"]
+        report["today_requests"] = today_stats["requests"]
+        if today_stats["partial"]:
+            # 部分统计不保存到额度快照
+            report["partial"] = True
+            today_request_count = today_cost = None
+
+    store = get_quota_store()
+    if store is not None:
+        try:
+            store.record(report["account"], report["key_id"], report["name"], report["remain_quota"],
+                         report["used_quota"], report["unlimited_quota"], today_request_count, today_cost)
+        except Exception as e:
+            logging.error(f"保存额度快照失败, msg: {e}")
+
+    report["low_credit"] = report["credit"] < 0.2
+    if report["low_credit"]:
+        report["text"] += f"  \n  *余额不足，请及时充值*"
+    if (report["notify_reason"] is None and policy is not None and policy.on_change
+            and policy.changed(report["key"], report["text"])):
+        report["notify_reason"] = "内容变化"
+    return report
+
+
+# 正在查询的令牌，上一次任务超出时间预算后仍在后台运行的查询不会被重复发起
+_inflight_tokens = set()
+_inflight_lock = threading.Lock()
+
+
+@contextmanager
+def single_flight(report_key, threads=None):
+    """
+    同一令牌同时只允许一个查询，返回是否获得执行权
+
+    Args:
+        threads: 查询提交到线程池的 Future 列表。异步任务被取消时线程中的请求仍在继续，
+            退出时等其中未完成的全部结束后才释放
+    """
+    with _inflight_lock:
+        acquired = report_key not in _inflight_tokens
+        if acquired:
+            _inflight_tokens.add(report_key)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            pending = [future for future in threads or () if not future.done()]
+            if pending:
+                _release_after(report_key, pending)
+            else:
+                _release_flight(report_key)
+
+
+def _release_flight(report_key):
+    with _inflight_lock:
+        _inflight_tokens.discard(report_key)
+
+
+def _release_after(report_key, futures):
+    left = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            left[0] -= 1
+            finished = left[0] == 0
+        if finished:
+            _release_flight(report_key)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def remaining(deadline):
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+# 拉取今日日志提前于任务截止时间停止，留出生成报告的时间，使超出预算的令牌仍能带着余额返回
+REPORT_GRACE = 1
+
+
+def log_deadline(deadline):
+    return None if deadline is None else deadline - REPORT_GRACE
+
+
+def skipped_report(aigc_api, key_id, reason, partial=True):
+    """
+    未能在本次任务中完成查询的令牌，只记录日志，不发送通知
+
+    Args:
+        partial: 是否将本次结果标记为部分结果；登录或查询失败时为 False，失败已单独记录或通知
+    """
+    report_key = f"{aigc_api.turboai.get('name')}/{key_id}"
+    return {
+        "key": report_key,
+        "key_id": key_id,
+        "account": aigc_api.turboai.get("name"),
+        "host": aigc_api.host_url,
+        "text": f"{report_key} {reason}",
+        "credit": None,
+        "low_credit": False,
+        "seconds_left": None,
+        "burn_rate": None,
+        "notify_reason": None,
+        "partial": partial,
+        "skipped": True,
+    }
+
+
+def build_token_report(aigc_api, key_id, policy=None, deadline=None):
+    """
+    查询单个令牌并生成报告
+
+    Args:
+        aigc_api: 令牌所属账号的 AigcApi
+        key_id: 令牌 id
+        policy: 通知策略，判断无需通知时不再拉取今日日志
+        deadline: 本次任务的截止时间（time.monotonic()），到达前 REPORT_GRACE 秒停止拉取今日日志，
+            报告带着余额和已拉取部分的今日统计返回，并标记为部分结果
+
+    Returns:
+        报告字典，见 summarize_token
+    """
+    with single_flight(f"{aigc_api.turboai.get('name')}/{key_id}") as acquired:
+        if not acquired:
+            return skipped_report(aigc_api, key_id, "上一次查询仍在进行，本次跳过")
+        token_data = aigc_api.get_token(key_id, deadline)
+        report = summarize_token(aigc_api, key_id, token_data, policy)
+        today = None
+        if wants_today(report, policy):
+            if remaining(log_deadline(deadline)) == 0:
+                report["partial"] = True
+            else:
+                try:
+                    today = fetch_today(aigc_api, key_id, report["name"], log_deadline(deadline))
+                except Exception as e:
+                    logging.error(f"获取今日消费信息失败, msg: {e}")
+        return finish_token_report(report, policy, today)
+
+
+async def build_token_report_async(aigc_api, key_id, policy=None, deadline=None, executor=None):
+    """
+    build_token_report 的异步版本。已知令牌名称且今日消费一定需要时，查询令牌和拉取今日日志同时进行。
+    请求在 executor 的线程中执行，任务被取消后线程中的请求结束时才释放 single_flight
+    """
+    report_key = f"{aigc_api.turboai.get('name')}/{key_id}"
+    threads = []
+    with single_flight(report_key, threads) as acquired:
+        if not acquired:
+            return skipped_report(aigc_api, key_id, "上一次查询仍在进行，本次跳过")
+        return await _build_token_report_async(aigc_api, key_id, report_key, policy, deadline, executor, threads)
+
+
+async def _build_token_report_async(aigc_api, key_id, report_key, policy, deadline, executor, threads):
+    import asyncio
+
+    def in_thread(func, *args):
+        future = executor.submit(func, *args)
+        threads.append(future)
+        return asyncio.wrap_future(future)
+
+    cached_name = _token_names.get(report_key)
+    today = None
+    if cached_name is not None and in_today_hours() and (policy is None or policy.on_change):
+        token_data, today = await asyncio.gather(
+            in_thread(aigc_api.get_token, key_id, deadline),
+            in_thread(fetch_today, aigc_api, key_id, cached_name, log_deadline(deadline)),
+            return_exceptions=True,
+        )
+        if isinstance(token_data, BaseException):
+            raise token_data
+        if isinstance(today, BaseException):
+            logging.error(f"获取今日消费信息失败, msg: {today}")
+            today = None
+    else:
+        token_data = await in_thread(aigc_api.get_token, key_id, deadline)
+
+    report = summarize_token(aigc_api, key_id, token_data, policy)
+    if report.get("name") != cached_name:
+        # 令牌名称变化，之前按旧名称拉取的日志作废
+        today = None
+    if today is None and wants_today(report, policy):
+        if remaining(log_deadline(deadline)) == 0:
+            report["partial"] = True
+        else:
             try:
-                today_request_count, today_cost, total_tokens_today = (
-                    aigc_api.get_dashboard_with_log()
-                )
-                text += f"  \n"
-                text += f"  \n  今日消费: {currency}{today_cost}"
-                text += f"  \n  今日请求: {today_request_count}次"
-                text += f"  \n  今日Token: {total_tokens_today}"
+                today = await in_thread(fetch_today, aigc_api, key_id, report["name"], log_deadline(deadline))
             except Exception as e:
                 logging.error(f"获取今日消费信息失败, msg: {e}")
+    return finish_token_report(report, policy, today)
 
-        if credit < 0.2:
-            text += f"  \n  *余额不足，请及时充值*"
-            aigc_api_host = config.get("turboai", "host", "https://api.uniapi.me")
-            action_url = urljoin(aigc_api_host, "/dashboard/topup")
-            external_page_url = f"dingtalk://dingtalkclient/page/link?url={quote(action_url, 'utf-8')}&pc_slide=false"
-            action_card_btns.append(
-                {"title": "立即充值", "actionURL": external_page_url}
-            )
-
-        if scheduler:
-            current_job = scheduler.get_jobs()[0]
-            if credit < 0.2:
-                current_job.reschedule(
-                    trigger="cron", hour="9,12,15,18", minute=0
-                )
-                logging.info(
-                    "UniAPI Credit is less than 0.2. Switching to every hour."
-                )
-            else:
-                current_job.reschedule(
-                    trigger="cron", hour="9,17", minute=0
-                )
-                logging.info(
-                    "UniAPI Credit is sufficient. Switching to 9:00 and 17:00."
-                )
+
+def format_top_models(breakdown, one_yuan_units, currency):
+    """
+    按消费从高到低列出前 N 个模型，以及每个模型请求耗时和单次请求 token 数的 p50/p95/p99
+    """
+    top_n = config.get("report", "top_models", 5)
+    show_quantiles = config.get("report", "quantiles", True)
+    if not top_n or not len(breakdown):
+        return ""
+    text = f"  \n  \n  **模型消费 Top{top_n}:**"
+    for item in breakdown.top(top_n):
+        tokens = item["prompt_tokens"] + item["completion_tokens"]
+        text += (
+            f"  \n  - {item['model']}: {currency}{round(item['quota'] / one_yuan_units, 3)}"
+            f" / {item['count']}次 / {tokens}tokens"
+        )
+        if show_quantiles and item["latency"][0] is not None:
+            latency = "/".join(f"{value:.3g}" for value in item["latency"])
+            tokens_per_request = "/".join(f"{value:.0f}" for value in item["tokens"])
+            text += f"  \n    耗时 p50/p95/p99: {latency}s, 单次Token: {tokens_per_request}"
+    return text
+
+
+def topup_button(aigc_api_host):
+    action_url = urljoin(aigc_api_host, "/dashboard/topup")
+    external_page_url = f"dingtalk://dingtalkclient/page/link?url={quote(action_url, 'utf-8')}&pc_slide=false"
+    return {"title": "立即充值", "actionURL": external_page_url}
+
+
+def reschedule_job(scheduler, reports):
+    """
+    调整定时任务。adaptive 模式下按预计耗尽时间最短的令牌计算下一次轮询间隔；
+    cron 模式下按余额是否不足切换固定的时间点。
+    """
+    credits = [report["credit"] for report in reports if report["credit"] is not None]
+    if not credits:
+        return
+    current_job = scheduler.get_job(JOB_ID)
+    if current_job is None:
+        return
+    if config.get("schedule", "mode", "adaptive") == "adaptive":
+        seconds_left = [report["seconds_left"] for report in reports if report["seconds_left"] is not None]
+        interval = next_poll_interval(
+            min(seconds_left) if seconds_left else None,
+            min_interval=config.get("schedule", "min_interval", 300),
+            max_interval=config.get("schedule", "max_interval", 4 * 3600),
+            divisor=config.get("schedule", "divisor", 10),
+        )
+        current_job.reschedule(trigger="interval", seconds=interval)
+        next_run = datetime.now() + timedelta(seconds=interval)
+        if in_active_hours(next_run):
+            logging.info(f"UniAPI next check in {interval} seconds.")
+        else:
+            # 下一次轮询落在通知时段外时，提前到下一个通知时段开始时检查
+            next_run = next_active_start(next_run)
+            current_job.modify(next_run_time=next_run)
+            logging.info(f"UniAPI next check at {next_run:%Y-%m-%d %H:%M}.")
+    elif min(credits) < 0.2:
+        current_job.reschedule(
+            trigger="cron", hour="9,12,15,18", minute=0
+        )
+        logging.info(
+            "UniAPI Credit is less than 0.2. Switching to every hour."
+        )
     else:
-        msg = token_data.get("message")
-        text += f"UniAPI余额查询失败, msg: {msg}"
+        current_job.reschedule(
+            trigger="cron", hour="9,17", minute=0
+        )
+        logging.info(
+            "UniAPI Credit is sufficient. Switching to 9:00 and 17:00."
+        )
+
+
+def in_active_hours(moment):
+    """
+    是否在 adaptive 模式的通知时段内，时段的结束小时包含在内
+    """
+    start_hour, end_hour = config.get("schedule", "active_hours", [9, 19])
+    return start_hour <= moment.hour <= end_hour
+
+
+def next_active_start(moment):
+    """
+    moment 之后下一个通知时段的开始时间
+    """
+    start_hour, _ = config.get("schedule", "active_hours", [9, 19])
+    start = moment.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+    return start if start > moment else start + timedelta(days=1)
+
+
+def should_run(scheduler=None):
+    adaptive = scheduler is not None and config.get("schedule", "mode", "adaptive") == "adaptive"
+    if not is_workday():
+        logging.info("今天不是工作日，不执行任务")
+        if adaptive:
+            skip_to_active_hours(scheduler, datetime.now())
+        return False
+    if adaptive and not in_active_hours(datetime.now()):
+        logging.info("当前不在通知时段内，不执行任务")
+        skip_to_active_hours(scheduler, datetime.now())
+        return False
+    return True
+
+
+def skip_to_active_hours(scheduler, now):
+    """
+    跳过时段外的轮询，下一次在下一个通知时段开始时执行
+    """
+    current_job = scheduler.get_job(JOB_ID)
+    if current_job is None:
+        return
+    next_run = next_active_start(now)
+    current_job.modify(next_run_time=next_run)
+    logging.info(f"UniAPI next check at {next_run:%Y-%m-%d %H:%M}.")
+
+
+def create_bot():
+    # 通知并行发送到配置的所有渠道，由各渠道的后台线程发送，不阻塞余额查询
+    return get_notifier()
+
+
+def dispatch_reports(bot, reports, policy=None, scheduler=None):
+    """
+    调整定时任务，并按报告模式和通知策略发送报告
+    """
+    partial = [report["key"] for report in reports if report.get("partial")]
+    if partial:
+        JOB_PARTIAL.inc(job=JOB_ID)
+        logging.warning(f"本次任务超出时间预算或有查询仍在进行，部分结果: {', '.join(partial)}")
+    for report in reports:
+        if report.get("skipped"):
+            logging.warning(report["text"])
+    reports = [report for report in reports if not report.get("skipped")]
+    if not reports:
+        return
+
+    if scheduler:
+        reschedule_job(scheduler, reports)
 
-    logging.info(text)
     title = "UniAPI 余额"
+    report_mode = config.get("report", "mode", "combined")
+    due_reports = [report for report in reports if report["notify_reason"] is not None]
+    for report in reports:
+        logging.info(report["text"])
+        if report["notify_reason"] is None:
+            logging.info(f"{report['key']} 无明显变化，本次不通知")
+    if report_mode == "per_token":
+        messages = [
+            ([report], [topup_button(report["host"])] if report["low_credit"] else [])
+            for report in due_reports
+        ]
+    elif due_reports:
+        # 合并模式下任一令牌需要通知时，发送所有令牌的报告
+        hosts = list(dict.fromkeys(report["host"] for report in reports if report["low_credit"]))
+        messages = [(reports, [topup_button(host) for host in hosts])]
+    else:
+        messages = []
 
     global first_run
-    if not first_run:
-        bot.send_action_card(title=title, text=text, btns=action_card_btns)
+    for message_reports, action_card_btns in messages:
+        text = "  \n  \n  ---  \n  \n  ".join(report["text"] for report in message_reports)
+        if partial:
+            text += "  \n  \n  *部分令牌未能在本次查询中完成，以上为部分结果*"
+        if not first_run:
+            bot.send_report(title, text, action_card_btns)
+            if policy is not None:
+                for report in message_reports:
+                    policy.mark_sent(report["key"], report["text"], report["credit"], report["burn_rate"])
     first_run = False
 
 
+def job_failed(reports):
+    """
+    本次任务是否有令牌未能查询到余额（登录失败、查询失败、超时或被跳过）
+    """
+    return any(report.get("skipped") or report["credit"] is None for report in reports)
+
+
+def tick_deadline():
+    """
+    本次任务的截止时间，超过后返回已完成的部分结果，未完成的查询留在后台，不阻塞下一次任务
+    """
+    budget = config.get("schedule", "tick_budget", 50)
+    return time.monotonic() + budget if budget else None
+
+
+def do_job_aigc(scheduler=None):
+    """
+    Returns:
+        本次任务的报告列表，超出时间预算或仍在查询的令牌带有 partial 标记
+    """
+    deadline = tick_deadline()
+    if not should_run(scheduler):
+        return []
+    bot = create_bot()
+
+    accounts = config.get_accounts()
+    policy = get_notification_policy()
+    max_workers = config.get("turboai", "max_workers", 8)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # 每个账号复用进程内的已登录会话，仅在未登录或会话失效时登录
+        apis = [session_manager.get(account) for account in accounts]
+        login_futures = [executor.submit(aigc_api.ensure_login) for aigc_api in apis]
+        done, _ = wait(login_futures, timeout=remaining(deadline))
+        reports = []
+        tasks = {}
+        for aigc_api, future in zip(apis, login_futures):
+            key_ids = aigc_api.turboai.get("key_ids", [])
+            if future not in done:
+                reports.extend(skipped_report(aigc_api, key_id, "登录超时，本次跳过") for key_id in key_ids)
+                continue
+            if not future.result():
+                bot.send_text(f"UniAPI登录失败({aigc_api.turboai.get('name')})")
+                reports.extend(skipped_report(aigc_api, key_id, "登录失败", partial=False) for key_id in key_ids)
+                continue
+            for key_id in key_ids:
+                task = executor.submit(build_token_report, aigc_api, key_id, policy, deadline)
+                tasks[task] = (aigc_api, key_id)
+        done, _ = wait(tasks, timeout=remaining(deadline))
+    finally:
+        # 不等待超时的查询，它们在后台完成后释放 single_flight
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for future, (aigc_api, key_id) in tasks.items():
+        if future not in done:
+            reports.append(skipped_report(aigc_api, key_id, "查询超出本次时间预算，本次跳过"))
+            continue
+        try:
+            reports.append(future.result())
+        except Exception as e:
+            logging.error(f"查询令牌失败, msg: {e}")
+            reports.append(skipped_report(aigc_api, key_id, "查询失败", partial=False))
+    dispatch_reports(bot, reports, policy, scheduler)
+    return reports
+
+
+async def do_job_aigc_async(scheduler=None):
+    """
+    异步版本的任务：工作日判断与各账号登录同时进行，所有令牌的查询并发执行，
+    一次任务的耗时接近最慢的单个请求链。
+
+    请求在本次任务专用的线程池中执行，超出时间预算的查询被取消，任务返回时不等待仍在运行的线程，
+    asyncio.run 关闭事件循环时也不会等待它们
+    """
+    import asyncio
+
+    deadline = tick_deadline()
+    accounts = config.get_accounts()
+    policy = get_notification_policy()
+    apis = [session_manager.get(account) for account in accounts]
+    # 每个令牌同时查询余额和拉取今日日志，最多占用两个线程
+    executor = ThreadPoolExecutor(max_workers=config.get("turboai", "max_workers", 8) * 2)
+    try:
+        run_task = asyncio.wrap_future(executor.submit(should_run, scheduler))
+        login_tasks = [asyncio.wrap_future(executor.submit(aigc_api.ensure_login)) for aigc_api in apis]
+        done, pending = await asyncio.wait([run_task, *login_tasks], timeout=remaining(deadline))
+        for task in pending:
+            task.cancel()
+        if run_task not in done:
+            logging.warning("工作日判断超出本次时间预算，跳过本次任务")
+            return []
+        if not run_task.result():
+            return []
+        bot = create_bot()
+
+        reports = []
+        tasks = {}
+        for aigc_api, login_task in zip(apis, login_tasks):
+            key_ids = aigc_api.turboai.get("key_ids", [])
+            if login_task not in done:
+                reports.extend(skipped_report(aigc_api, key_id, "登录超时，本次跳过") for key_id in key_ids)
+                continue
+            if not login_task.result():
+                bot.send_text(f"UniAPI登录失败({aigc_api.turboai.get('name')})")
+                reports.extend(skipped_report(aigc_api, key_id, "登录失败", partial=False) for key_id in key_ids)
+                continue
+            for key_id in key_ids:
+                task = asyncio.ensure_future(build_token_report_async(aigc_api, key_id, policy, deadline, executor))
+                tasks[task] = (aigc_api, key_id)
+
+        done, pending = await asyncio.wait(tasks, timeout=remaining(deadline)) if tasks else (set(), set())
+        # 取消超出预算的查询，线程中的请求结束后才释放 single_flight
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for task, (aigc_api, key_id) in tasks.items():
+        if task in pending:
+            reports.append(skipped_report(aigc_api, key_id, "查询超出本次时间预算，本次跳过"))
+            continue
+        try:
+            reports.append(task.result())
+        except Exception as e:
+            logging.error(f"查询令牌失败, msg: {e}")
+            reports.append(skipped_report(aigc_api, key_id, "查询失败", partial=False))
+    dispatch_reports(bot, reports, policy, scheduler)
+    return reports
+
+
 def job_aigc(scheduler=None):
     try:
-        do_job_aigc(scheduler)
+        with time_job(JOB_ID):
+            do_job_aigc(scheduler)
     except Exception as e:
         logging.error(e)
 
 
-if __name__ == "__main__":
+def job_anomaly():
+    try:
+        with time_job(ANOMALY_JOB_ID):
+            run_anomaly_check()
+    except Exception as e:
+        logging.error(e)
+
+
+async def job_aigc_async(scheduler=None):
+    try:
+        with time_job(JOB_ID):
+            await do_job_aigc_async(scheduler)
+    except Exception as e:
+        logging.error(e)
+
+
+def run_once():
+    """
+    只执行一次任务，不启动调度器，用于 systemd timer、Kubernetes CronJob 等外部调度
+
+    Returns:
+        进程退出码，任务失败、有账号登录失败或令牌查询失败、报告未能发出时为 1
+    """
+    global first_run
+    first_run = False
+    setup_logging(mode="a")
+    started_job = time.perf_counter()
+    exit_code = 0
+    try:
+        with time_job(JOB_ID):
+            if config.get("schedule", "asyncio", False):
+                import asyncio
+
+                reports = asyncio.run(do_job_aigc_async())
+            else:
+                reports = do_job_aigc()
+        if job_failed(reports):
+            exit_code = 1
+    except Exception as e:
+        logging.error(e)
+        exit_code = 1
+    if not get_notifier().flush(timeout=30):
+        logging.error("报告未能全部发出")
+        exit_code = 1
+    finished = time.perf_counter()
+    logging.info(
+        f"导入耗时 {(IMPORTED_AT - STARTED_AT) * 1000:.1f}ms, "
+        f"启动耗时 {(started_job - STARTED_AT) * 1000:.1f}ms, "
+        f"任务耗时 {(finished - started_job) * 1000:.1f}ms"
+    )
+    return exit_code
+
+
+def job_defaults():
+    """
+    同一任务不重叠执行；错过的多次执行合并为一次，超过 misfire_grace_time 秒的直接跳过
+    """
+    return {
+        "coalesce": True,
+        "max_instances": 1,
+        "misfire_grace_time": config.get("schedule", "misfire_grace_time", 30),
+    }
+
+
+def watch_scheduler(scheduler):
+    """
+    记录任务计划时间与实际开始时间的延迟，以及因错过或上一次仍在执行而跳过的任务
+    """
+    from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+
+    lag_warning = config.get("schedule", "lag_warning", 10)
+
+    def listener(event):
+        if event.code == EVENT_JOB_SUBMITTED:
+            lag = time.time() - event.scheduled_run_times[-1].timestamp()
+            JOB_LAG.set(round(lag, 3), job=event.job_id)
+            if lag >= lag_warning:
+                logging.warning(f"任务 {event.job_id} 计划于 {event.scheduled_run_times[-1]:%H:%M:%S}，"
+                                f"实际延迟 {lag:.1f} 秒开始")
+            if len(event.scheduled_run_times) > 1:
+                JOB_SKIPPED.inc(len(event.scheduled_run_times) - 1, job=event.job_id, reason="coalesced")
+                logging.warning(f"任务 {event.job_id} 错过的 {len(event.scheduled_run_times) - 1} 次执行已合并")
+        elif event.code == EVENT_JOB_MISSED:
+            JOB_SKIPPED.inc(job=event.job_id, reason="missed")
+            logging.warning(f"任务 {event.job_id} 错过了 {event.scheduled_run_time:%H:%M:%S} 的执行")
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            JOB_SKIPPED.inc(job=event.job_id, reason="overlap")
+            logging.warning(f"任务 {event.job_id} 上一次仍在执行，跳过本次")
+
+    scheduler.add_listener(listener, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+
+def run_scheduler():
+    global first_run
     first_run = True
     setup_logging()
-    background_scheduler = BackgroundScheduler()
-    job_aigc = background_scheduler.add_job(
-        job_aigc,
+    use_asyncio = config.get("schedule", "asyncio", False)
+    if use_asyncio:
+        import asyncio
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        scheduler = AsyncIOScheduler(event_loop=event_loop, job_defaults=job_defaults())
+    else:
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        scheduler = BackgroundScheduler(job_defaults=job_defaults())
+    watch_scheduler(scheduler)
+    scheduler.add_job(
+        job_aigc_async if use_asyncio else job_aigc,
         "cron",
         minute="*/1",
-        args=[background_scheduler],
+        args=[scheduler],
+        id=JOB_ID,
     )
+    if config.get("anomaly", "enabled", False):
+        # 异常检测不区分工作日，每分钟只处理上一分钟新增的日志
+        scheduler.add_job(job_anomaly, "cron", minute="*", second=5, id=ANOMALY_JOB_ID)
     logging.info("UniAPI notify app is running.")
-    background_scheduler.start()
+    scheduler.start()
+    if config.get("metrics", "enabled", False):
+        start_metrics_server(
+            config.get("metrics", "host", "127.0.0.1"), config.get("metrics", "port", 9108)
+        )
+    if config.get("api", "enabled", False):
+        start_query_server(config.get("api", "host", "127.0.0.1"), config.get("api", "port", 9109))
 
     try:
-        # This is here to simulate application activity (which keeps the main thread alive).
-        while True:
-            time.sleep(10)
+        if use_asyncio:
+            event_loop.run_forever()
+        else:
+            # This is here to simulate application activity (which keeps the main thread alive).
+            while True:
+                time.sleep(10)
     except (KeyboardInterrupt, SystemExit):
         # Not strictly necessary if daemonic mode is enabled but should be done if possible
-        background_scheduler.shutdown()
+        scheduler.shutdown()
+        get_notifier().flush(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UniAPI 余额通知")
+    parser.add_argument("--once", action="store_true", help="只执行一次任务后退出，不启动调度器")
+    args = parser.parse_args()
+    if args.once:
+        sys.exit(run_once())
+    run_scheduler()
@@ -0,0 +1,206 @@
+"""
+Prometheus 文本格式的指标采集和 /metrics 接口
+"""
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶的计数（非累计）、总和、总数
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, key, value) -> list[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+HTTP_REQUEST_DURATION = Histogram(
+    "turboai_http_request_duration_seconds", "Outbound HTTP request latency",
+    ("service", "endpoint", "status"),
+)
+HTTP_RETRIES = Counter("turboai_http_retries_total", "Outbound HTTP request retries", ("service",))
+HTTP_FAILURES = Counter(
+    "turboai_http_failures_total", "Outbound HTTP requests that failed", ("service", "endpoint")
+)
+LOG_PAGES = Counter("turboai_log_pages_total", "Log pages fetched from /api/log/self")
+TODAY_REQUESTS = Counter(
+    "turboai_today_requests_total", "Upstream requests spent on today's stats, by source", ("source",)
+)
+JOB_DURATION = Histogram(
+    "turboai_job_duration_seconds", "Scheduled job duration", ("job", "status"),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+JOB_LAST_SUCCESS = Gauge("turboai_job_last_success_timestamp_seconds", "Last successful job run", ("job",))
+JOB_LAG = Gauge("turboai_job_start_lag_seconds", "Delay between scheduled and actual job start", ("job",))
+JOB_SKIPPED = Counter("turboai_job_skipped_total", "Scheduled job runs skipped or coalesced", ("job", "reason"))
+JOB_PARTIAL = Counter("turboai_job_partial_total", "Job runs that returned partial results", ("job",))
+
+
+@contextmanager
+def time_request(service: str, endpoint: str):
+    """
+    记录一次外部请求的耗时。调用方可将返回字典的 status 设置为 HTTP 状态码，异常时记为 error
+    """
+    result = {"status": "ok"}
+    started = time.perf_counter()
+    try:
+        yield result
+    except Exception:
+        result["status"] = "error"
+        raise
+    finally:
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - started, service=service, endpoint=endpoint, status=result["status"]
+        )
+        status = result["status"]
+        if status == "error" or (status.isdigit() and int(status) >= 400):
+            HTTP_FAILURES.inc(service=service, endpoint=endpoint)
+
+
+@contextmanager
+def time_job(job: str):
+    """
+    记录一次定时任务的耗时和结果
+    """
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        JOB_DURATION.observe(time.perf_counter() - started, job=job, status=status)
+        if status == "ok":
+            JOB_LAST_SUCCESS.set(time.time(), job=job)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host: str = "127.0.0.1", port: int = 9108) -> Optional[ThreadingHTTPServer]:
+    """
+    在后台线程中启动 /metrics 接口，启动失败时只记录日志
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logging.error(f"启动指标接口失败: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
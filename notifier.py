@@ -0,0 +1,445 @@
+"""
+通知渠道：钉钉、企业微信、飞书、Slack 兼容的 webhook 和 SMTP 邮件。
+
+NotifierGroup 将同一份报告并行发送到所有配置的渠道，每个渠道有独立的发送线程和超时，
+一个渠道变慢或失败不影响其他渠道，也不阻塞任务本身。
+"""
+
+import abc
+import base64
+import hashlib
+import hmac
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Optional
+
+LINE_BREAK = "  \n  "
+
+
+class Notifier(abc.ABC):
+    """
+    通知渠道的接口。报告正文使用钉钉风格的 markdown（行尾两个空格换行、**加粗**），各渠道自行转换
+
+    Args:
+        name: 渠道名称，用于日志
+        timeout: 单次发送（包括拆分后的多条、重试和退避）的总时长上限（秒）
+    """
+
+    def __init__(self, name: str, timeout: float = 10):
+        self.name = name
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @contextmanager
+    def sending(self):
+        """一次发送的截止时间，期间的所有请求共用"""
+        self._local.deadline = time.monotonic() + self.timeout
+        try:
+            yield
+        finally:
+            self._local.deadline = None
+
+    def deadline(self) -> float:
+        """当前发送的截止时间（time.monotonic()），不在 sending() 中时从现在开始计算"""
+        deadline = getattr(self._local, "deadline", None)
+        return time.monotonic() + self.timeout if deadline is None else deadline
+
+    @abc.abstractmethod
+    def send_text(self, text: str):
+        """发送纯文本消息"""
+
+    def send_markdown(self, title: str, text: str):
+        return self.send_text(f"{title}\n{plain_text(text)}")
+
+    def send_report(self, title: str, text: str, buttons: Optional[list[dict]] = None):
+        """
+        发送报告，buttons 为 [{"title": ..., "actionURL": ...}]，不支持按钮的渠道以链接形式附在末尾
+        """
+        links = "".join(f"{LINE_BREAK}[{button['title']}]({button['actionURL']})" for button in buttons or [])
+        return self.send_markdown(title, text + links)
+
+    # 自带后台发送队列的渠道为 True，由 NotifierGroup 在调用线程直接入队
+    queued = False
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return True
+
+
+def plain_text(text: str) -> str:
+    """钉钉 markdown 转为纯文本"""
+    text = text.replace(LINE_BREAK, "\n").replace("  \n", "\n")
+    text = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"\1: \2", text)
+    return text.replace("**", "").replace("*", "")
+
+
+def numbered(chunks: list[str]) -> list[str]:
+    if len(chunks) == 1:
+        return chunks
+    return [f"({index}/{len(chunks)}) {chunk}" for index, chunk in enumerate(chunks, 1)]
+
+
+class WebhookNotifier(Notifier):
+    """
+    通过 webhook 发送 JSON 的渠道，请求经由共享的传输层
+
+    Args:
+        webhook: 机器人地址
+        retries: 连接失败或 429/5xx 时的重试次数
+        max_bytes: 单条消息正文的上限，超过时拆分为带编号的多条
+    """
+
+    max_bytes = 20000
+
+    def __init__(self, name: str, webhook: str, timeout: float = 10, retries: int = 2,
+                 max_bytes: Optional[int] = None):
+        super().__init__(name, timeout)
+        self.webhook = webhook
+        self.retries = retries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def url(self) -> str:
+        return self.webhook
+
+    def check(self, response) -> None:
+        """检查响应，发送失败时抛出异常"""
+        response.raise_for_status()
+
+    def post(self, payload: dict) -> bool:
+        from http_client import get_transport
+        from metrics import time_request
+
+        transport = get_transport()
+        with time_request(self.name, "webhook") as timing:
+            response = transport.request(
+                "POST", self.url(), json=payload, timeout=(transport.timeout[0], self.timeout),
+                retry=self.retries > 0, max_retries=self.retries, deadline=self.deadline(), service=self.name,
+            )
+            timing["status"] = str(response.status_code)
+            self.check(response)
+        return True
+
+    def split(self, text: str) -> list[str]:
+        from DingTalkBot import split_text
+
+        return numbered(split_text(text, self.max_bytes - 16))
+
+
+class WeComNotifier(WebhookNotifier):
+    """企业微信群机器人，markdown 消息内容最长 4096 字节"""
+
+    max_bytes = 4096
+
+    def check(self, response) -> None:
+        response.raise_for_status()
+        data = response.json()
+        if data.get("errcode", 0) != 0:
+            raise RuntimeError(data)
+
+    def send_text(self, text: str):
+        return all([self.post({"msgtype": "text", "text": {"content": chunk}}) for chunk in self.split(text)])
+
+    def send_markdown(self, title: str, text: str):
+        text = f"**{title}**\n{text.replace(LINE_BREAK, chr(10))}"
+        return all([self.post({"msgtype": "markdown", "markdown": {"content": chunk}})
+                    for chunk in self.split(text)])
+
+
+class FeishuNotifier(WebhookNotifier):
+    """
+    飞书自定义机器人，报告以消息卡片发送，按钮对应卡片中的跳转按钮
+
+    Args:
+        secret: 签名校验的密钥，未开启签名校验时为空
+    """
+
+    def __init__(self, name: str, webhook: str, secret: Optional[str] = None, **kwargs):
+        super().__init__(name, webhook, **kwargs)
+        self.secret = secret
+
+    def signed(self, payload: dict) -> dict:
+        if not self.secret:
+            return payload
+        timestamp = str(int(time.time()))
+        string_to_sign = f"{timestamp}\n{self.secret}".encode("utf-8")
+        sign = base64.b64encode(hmac.new(string_to_sign, digestmod=hashlib.sha256).digest()).decode()
+        return {"timestamp": timestamp, "sign": sign, **payload}
+
+    def check(self, response) -> None:
+        response.raise_for_status()
+        data = response.json()
+        if data.get("code", data.get("StatusCode", 0)) != 0:
+            raise RuntimeError(data)
+
+    def send_text(self, text: str):
+        return all([self.post(self.signed({"msg_type": "text", "content": {"text": chunk}}))
+                    for chunk in self.split(text)])
+
+    def send_report(self, title: str, text: str, buttons: Optional[list[dict]] = None):
+        chunks = self.split(text.replace(LINE_BREAK, "\n"))
+        results = []
+        for index, chunk in enumerate(chunks):
+            elements = [{"tag": "div", "text": {"tag": "lark_md", "content": chunk}}]
+            if buttons and index == len(chunks) - 1:
+                elements.append({
+                    "tag": "action",
+                    "actions": [
+                        {"tag": "button", "text": {"tag": "plain_text", "content": button["title"]},
+                         "url": button["actionURL"], "type": "primary"}
+                        for button in buttons
+                    ],
+                })
+            card = {"header": {"title": {"tag": "plain_text", "content": title}}, "elements": elements}
+            results.append(self.post(self.signed({"msg_type": "interactive", "card": card})))
+        return all(results)
+
+    def send_markdown(self, title: str, text: str):
+        return self.send_report(title, text)
+
+
+class SlackNotifier(WebhookNotifier):
+    """Slack 及兼容 Slack incoming webhook 格式的渠道（如 Mattermost、Rocket.Chat）"""
+
+    max_bytes = 40000
+
+    def check(self, response) -> None:
+        response.raise_for_status()
+
+    @staticmethod
+    def mrkdwn(text: str) -> str:
+        text = text.replace(LINE_BREAK, "\n").replace("  \n", "\n")
+        text = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"<\2|\1>", text)
+        return re.sub(r"\*\*([^*]+)\*\*", r"*\1*", text)
+
+    def send_text(self, text: str):
+        return all([self.post({"text": chunk}) for chunk in self.split(text)])
+
+    def send_markdown(self, title: str, text: str):
+        return self.send_text(self.mrkdwn(f"**{title}**{LINE_BREAK}{text}"))
+
+
+class EmailNotifier(Notifier):
+    """
+    通过 SMTP（一般为本地中继）发送纯文本邮件
+
+    Args:
+        host: SMTP 服务器
+        port: 端口
+        sender: 发件人
+        recipients: 收件人列表
+        username: 需要认证时的用户名
+        password: 需要认证时的密码
+        starttls: 是否使用 STARTTLS
+    """
+
+    def __init__(self, name: str, host: str = "localhost", port: int = 25, sender: str = "",
+                 recipients: Optional[list[str]] = None, username: Optional[str] = None,
+                 password: Optional[str] = None, starttls: bool = False, timeout: float = 10):
+        super().__init__(name, timeout)
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients or []
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+
+    def send_mail(self, subject: str, body: str) -> bool:
+        import smtplib
+        from email.message import EmailMessage
+
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(body)
+        deadline = self.deadline()
+
+        def remaining() -> float:
+            # smtplib 的超时针对每次读写，每一步前按剩余时间重新设置，总时长不超过截止时间
+            seconds = deadline - time.monotonic()
+            if seconds <= 0:
+                raise TimeoutError(f"发送邮件超过 {self.timeout}s")
+            return seconds
+
+        with smtplib.SMTP(self.host, self.port, timeout=remaining()) as smtp:
+            if self.starttls:
+                smtp.sock.settimeout(remaining())
+                smtp.starttls()
+            if self.username:
+                smtp.sock.settimeout(remaining())
+                smtp.login(self.username, self.password or "")
+            smtp.sock.settimeout(remaining())
+            smtp.send_message(message)
+        return True
+
+    def send_text(self, text: str):
+        return self.send_mail(text.splitlines()[0][:80] if text else "通知", text)
+
+    def send_markdown(self, title: str, text: str):
+        return self.send_mail(title, plain_text(text))
+
+
+class DingTalkNotifier(Notifier):
+    """
+    钉钉机器人。DingTalkBot 自带限流、合并和重试的后台队列，send_* 入队后立即返回 Future；
+    timeout 包括排队等待限流的时间，到期仍未发出的消息不再发送
+    """
+
+    queued = True
+
+    def __init__(self, name: str, webhook: str, secret: Optional[str] = None, timeout: float = 60,
+                 rate_per_minute: int = 20):
+        super().__init__(name, timeout)
+        from DingTalkBot import DingTalkBot
+
+        self.bot = DingTalkBot(webhook, secret or None, asynchronous=True, rate_per_minute=rate_per_minute,
+                               timeout=timeout)
+
+    def send_text(self, text: str):
+        return self.bot.send_text(text)
+
+    def send_markdown(self, title: str, text: str):
+        return self.bot.send_markdown(title, text)
+
+    def send_report(self, title: str, text: str, buttons: Optional[list[dict]] = None):
+        return self.bot.send_action_card(title=title, text=text, btns=buttons or [])
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self.bot.flush(timeout)
+
+
+NOTIFIER_TYPES = {
+    "dingtalk": DingTalkNotifier,
+    "wecom": WeComNotifier,
+    "feishu": FeishuNotifier,
+    "slack": SlackNotifier,
+    "email": EmailNotifier,
+}
+
+
+class NotifierGroup(Notifier):
+    """
+    将消息并行发送到多个渠道。每个渠道一个发送线程，同一渠道内按顺序发送；
+    send_* 立即返回 {渠道名称: Future}，单个渠道慢或失败只记录日志，不影响其他渠道
+    """
+
+    def __init__(self, notifiers: list[Notifier]):
+        super().__init__("group")
+        self.notifiers = notifiers
+        self._executors = {
+            notifier.name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"notify-{notifier.name}")
+            for notifier in notifiers if not notifier.queued
+        }
+        self._pending = set()
+        # 上次 flush 以来发送失败的消息数
+        self._failed = 0
+        self._lock = threading.Lock()
+
+    def _run(self, notifier: Notifier, method: str, *args):
+        try:
+            with notifier.sending():
+                result = getattr(notifier, method)(*args)
+        except Exception as e:
+            logging.error(f"[{notifier.name}] 发送通知失败: {e}")
+            return False
+        if not result:
+            logging.error(f"[{notifier.name}] 发送通知失败")
+        return result
+
+    def _fan_out(self, method: str, *args) -> dict:
+        futures = {}
+        for notifier in self.notifiers:
+            if notifier.queued:
+                future = self._run(notifier, method, *args)
+                if not isinstance(future, Future):
+                    future, result = Future(), future
+                    future.set_result(result)
+            else:
+                future = self._executors[notifier.name].submit(self._run, notifier, method, *args)
+            with self._lock:
+                self._pending.add(future)
+            future.add_done_callback(self._discard)
+            futures[notifier.name] = future
+        return futures
+
+    def _discard(self, future) -> None:
+        error = future.exception()
+        if error is not None:
+            logging.error(f"发送通知失败: {error}")
+        with self._lock:
+            self._pending.discard(future)
+            if error is not None or not future.result():
+                self._failed += 1
+
+    def send_text(self, text: str):
+        return self._fan_out("send_text", text)
+
+    def send_markdown(self, title: str, text: str):
+        return self._fan_out("send_markdown", title, text)
+
+    def send_report(self, title: str, text: str, buttons: Optional[list[dict]] = None):
+        return self._fan_out("send_report", title, text, buttons)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待所有渠道中已提交的消息发送完毕。单条消息超时或失败不影响等待其余消息，
+        自上次 flush 以来有任何消息超时或发送失败时返回 False
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            pending = list(self._pending)
+        ok = True
+        for future in pending:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                ok = bool(future.result(remaining)) and ok
+            except FutureTimeoutError:
+                logging.warning("等待通知发送超时")
+                ok = False
+            except Exception:
+                # 失败已在 _discard 中记录日志
+                ok = False
+        for notifier in self.notifiers:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ok = notifier.flush(remaining) and ok
+        with self._lock:
+            failed, self._failed = self._failed, 0
+        return ok and not failed
+
+
+def create_notifier(conf: dict) -> Notifier:
+    conf = dict(conf)
+    notifier_type = conf.pop("type", "dingtalk")
+    if notifier_type not in NOTIFIER_TYPES:
+        raise ValueError(f"不支持的通知渠道类型: {notifier_type}")
+    conf.setdefault("name", notifier_type)
+    return NOTIFIER_TYPES[notifier_type](**conf)
+
+
+_group = None
+_group_lock = threading.Lock()
+
+
+def get_notifier() -> NotifierGroup:
+    """
+    获取进程内共享的通知渠道组，渠道来自配置 [[notifiers]]，未配置时使用 active_dingtalk 指定的钉钉机器人
+    """
+    global _group
+    with _group_lock:
+        if _group is None:
+            from config import config
+
+            notifiers = []
+            for conf in config.get_notifiers():
+                try:
+                    notifiers.append(create_notifier(conf))
+                except (TypeError, ValueError) as e:
+                    logging.error(f"通知渠道配置有误 {conf.get('name', conf.get('type'))}: {e}")
+            _group = NotifierGroup(notifiers)
+        return _group
@@ -0,0 +1,130 @@
+"""
+通知策略：只在额度跨过阈值、明显下降、消耗突增或到达心跳间隔时发送通知
+"""
+
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from json_state import load_json, save_json
+
+
+class NotificationPolicy:
+    """
+    按令牌记录上一次发送通知时的状态，并判断本次是否需要发送
+
+    Args:
+        path: 状态文件路径
+        credit_bands: 额度档位，如 [5, 1, 0.2]，额度跨过任一档位时发送
+        drop_percent: 额度相比上次通知下降超过该百分比时发送
+        spike_factor: 消耗速度超过上次通知时的该倍数时发送
+        heartbeat: 距离上次通知超过该秒数时发送
+        on_change: 为 True 时报告内容（哈希）变化即发送
+        state: 令牌键到上次通知状态的映射（支持 get 和下标赋值），默认从 path 读取并写回 JSON 文件；
+            多个进程共享状态时传入共享存储，如 worker 的租约表
+    """
+
+    def __init__(self, path: str = "notify_state.json", credit_bands=(5, 1, 0.2), drop_percent: float = 10,
+                 spike_factor: float = 3, heartbeat: int = 8 * 3600, on_change: bool = False, state=None):
+        self.path = path
+        self.credit_bands = sorted(credit_bands, reverse=True)
+        self.drop_percent = drop_percent
+        self.spike_factor = spike_factor
+        self.heartbeat = heartbeat
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._file_backed = state is None
+        self._state = load_json(self.path, "通知状态") if state is None else state
+
+    def _save(self) -> None:
+        if self._file_backed:
+            save_json(self.path, self._state, "通知状态")
+
+    def band_of(self, credit: float) -> int:
+        """
+        额度所在档位，额度越低档位越大
+        """
+        return sum(1 for band in self.credit_bands if credit < band)
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def check(self, key: str, credit: Optional[float], burn_rate: Optional[float] = None,
+              now: Optional[float] = None) -> Optional[str]:
+        """
+        根据额度和消耗速度判断是否需要发送
+
+        Returns:
+            需要发送时返回原因，否则返回 None
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            last = self._state.get(key)
+        if last is None:
+            return "首次通知"
+        if now - last.get("sent_at", 0) >= self.heartbeat:
+            return "定时通知"
+        last_credit = last.get("credit")
+        if credit is None:
+            return "查询失败" if last_credit is not None else None
+        if last_credit is None:
+            return "额度恢复查询"
+        if self.band_of(credit) != self.band_of(last_credit):
+            return "额度跨过阈值"
+        if last_credit > 0 and (last_credit - credit) / last_credit * 100 >= self.drop_percent:
+            return f"额度下降超过{self.drop_percent}%"
+        last_rate = last.get("burn_rate")
+        if burn_rate and last_rate and burn_rate >= last_rate * self.spike_factor:
+            return "消耗速度突增"
+        return None
+
+    def changed(self, key: str, text: str) -> bool:
+        """
+        报告内容是否与上次通知不同
+        """
+        with self._lock:
+            last = self._state.get(key)
+        return last is None or last.get("digest") != self.digest(text)
+
+    def mark_sent(self, key: str, text: str, credit: Optional[float], burn_rate: Optional[float] = None,
+                  now: Optional[float] = None) -> None:
+        with self._lock:
+            self._state[key] = {
+                "sent_at": time.time() if now is None else now,
+                "digest": self.digest(text),
+                "credit": credit,
+                "burn_rate": burn_rate,
+            }
+            self._save()
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_notification_policy(state=None) -> Optional[NotificationPolicy]:
+    """
+    获取进程内共享的通知策略，配置 [notify] policy = false 时返回 None
+
+    Args:
+        state: 代替状态文件的共享状态存储（分片运行时多个 worker 共用），仅首次调用时生效
+    """
+    global _policy
+    from config import config
+
+    if not config.get("notify", "policy", False):
+        return None
+    with _policy_lock:
+        if _policy is None:
+            _policy = NotificationPolicy(
+                path=config.get("notify", "state_path", "notify_state.json"),
+                credit_bands=config.get("notify", "credit_bands", [5, 1, 0.2]),
+                drop_percent=config.get("notify", "drop_percent", 10),
+                spike_factor=config.get("notify", "spike_factor", 3),
+                heartbeat=config.get("notify", "heartbeat", 8 * 3600),
+                on_change=config.get("notify", "on_change", False),
+                state=state,
+            )
+        return _policy
@@ -0,0 +1,248 @@
+"""
+常驻进程的本地查询接口：内存中缓存最近的令牌余额和今日用量（带 TTL），通过 /balance 和 /today 提供查询，
+缓存过期时同时到达的多个请求只触发一次上游刷新
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class SnapshotCache:
+    """
+    带 TTL 的快照缓存，同一个 key 的并发刷新合并为一次
+
+    Args:
+        ttl: 快照的有效期（秒）
+        timeout: 等待其他请求刷新结果的最长时间（秒）
+    """
+
+    def __init__(self, ttl: float = 60, timeout: float = 120):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, value: dict, fetched_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() if fetched_at is None else fetched_at, value)
+
+    def peek(self, key):
+        """
+        返回 (获取时间, 快照)，没有缓存时返回 None，不检查是否过期
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def get(self, key, loader: Callable[[], dict]):
+        """
+        返回未过期的快照，过期时调用 loader 刷新；已有请求在刷新时等待其结果
+
+        Returns:
+            (获取时间, 快照)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                return entry
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            return future.result(timeout=self.timeout)
+
+        try:
+            value = loader()
+            entry = (time.time(), value)
+            with self._lock:
+                self._entries[key] = entry
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+def balance_snapshot(aigc_api, key_id, data: dict) -> dict:
+    """
+    由 get_token 返回的 data 生成余额快照
+    """
+    account = aigc_api.turboai
+    units = account.get("units", 500000)
+    return {
+        "account": account.get("name"),
+        "key_id": str(key_id),
+        "token_name": data.get("name"),
+        "unlimited": bool(data.get("unlimited_quota")),
+        "remain_quota": data.get("remain_quota"),
+        "used_quota": data.get("used_quota"),
+        "balance": round(data.get("remain_quota", 0) / units, 2),
+        "used": round(data.get("used_quota", 0) / units, 2),
+        "currency": account.get("currency", "¥"),
+    }
+
+
+def today_snapshot(aigc_api, key_id, token_name: str, request_count: int, cost: float, tokens,
+                   source: Optional[str] = None) -> dict:
+    return {
+        "account": aigc_api.turboai.get("name"),
+        "key_id": str(key_id),
+        "token_name": token_name,
+        "request_count": request_count,
+        "cost": cost,
+        "tokens": tokens,
+        "currency": aigc_api.turboai.get("currency", "¥"),
+        "day": time.strftime("%Y-%m-%d"),
+        "source": source,
+    }
+
+
+def publish_balance(aigc_api, key_id, data: dict) -> None:
+    """
+    定时任务查询到余额后写入缓存，查询接口无需再请求上游
+    """
+    get_snapshot_cache().put(("balance", aigc_api.turboai.get("name"), str(key_id)),
+                             balance_snapshot(aigc_api, key_id, data))
+
+
+def publish_today(aigc_api, key_id, token_name: str, request_count: int, cost: float, tokens,
+                  source: Optional[str] = None) -> None:
+    get_snapshot_cache().put(("today", aigc_api.turboai.get("name"), str(key_id)),
+                             today_snapshot(aigc_api, key_id, token_name, request_count, cost, tokens, source))
+
+
+class QueryService:
+    """
+    按账号和令牌查询余额与今日用量，优先使用缓存
+    """
+
+    def __init__(self, cache: SnapshotCache):
+        self.cache = cache
+
+    @staticmethod
+    def _targets(account: Optional[str] = None, key_id: Optional[str] = None):
+        from aigc_api import session_manager
+        from config import config
+
+        for turboai in config.get_accounts():
+            if account and turboai.get("name") != account:
+                continue
+            for token_id in turboai.get("key_ids", []):
+                if key_id and str(token_id) != str(key_id):
+                    continue
+                yield session_manager.get(turboai), str(token_id)
+
+    @staticmethod
+    def _load_balance(aigc_api, key_id) -> dict:
+        if not aigc_api.ensure_login():
+            raise RuntimeError("UniAPI登录失败")
+        token_data = aigc_api.get_token(key_id)
+        if not token_data.get("success"):
+            raise RuntimeError(token_data.get("message") or "令牌查询失败")
+        return balance_snapshot(aigc_api, key_id, token_data["data"])
+
+    def _load_today(self, aigc_api, key_id) -> dict:
+        _, balance = self._balance_entry(aigc_api, key_id)
+        token_name = balance["token_name"]
+        from today_stats import get_today_stats_provider
+
+        stats = get_today_stats_provider().fetch(aigc_api, key_id, token_name)
+        return today_snapshot(aigc_api, key_id, token_name, stats["request_count"], stats["cost"],
+                              stats["total_tokens"], stats["source"])
+
+    def _balance_entry(self, aigc_api, key_id):
+        key = ("balance", aigc_api.turboai.get("name"), key_id)
+        return self.cache.get(key, lambda: self._load_balance(aigc_api, key_id))
+
+    def _today_entry(self, aigc_api, key_id):
+        key = ("today", aigc_api.turboai.get("name"), key_id)
+        entry = self.cache.peek(key)
+        if entry is not None and entry[1]["day"] != time.strftime("%Y-%m-%d"):
+            # 跨天后昨天的用量即使未过期也不再返回
+            self.cache.put(key, entry[1], fetched_at=0)
+        return self.cache.get(key, lambda: self._load_today(aigc_api, key_id))
+
+    def query(self, kind: str, account: Optional[str] = None, key_id: Optional[str] = None) -> list[dict]:
+        load = self._balance_entry if kind == "balance" else self._today_entry
+        results = []
+        for aigc_api, token_id in self._targets(account, key_id):
+            try:
+                fetched_at, snapshot = load(aigc_api, token_id)
+                results.append(dict(snapshot, fetched_at=int(fetched_at), age=round(time.time() - fetched_at, 1)))
+            except Exception as e:
+                logging.error(f"查询{kind}失败({aigc_api.turboai.get('name')}/{token_id}), msg: {e}")
+                results.append({"account": aigc_api.turboai.get("name"), "key_id": token_id, "error": str(e)})
+        return results
+
+
+def make_handler(service: QueryService):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, data, status=200):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            kind = url.path.strip("/")
+            if kind not in ("balance", "today"):
+                return self._send_json({"error": "not found"}, 404)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            results = service.query(kind, query.get("account"), query.get("key_id"))
+            if not results:
+                return self._send_json({"error": "未找到令牌"}, 404)
+            status = 502 if all("error" in result for result in results) else 200
+            self._send_json({"data": results}, status)
+
+    return Handler
+
+
+def start_query_server(host: str = "127.0.0.1", port: int = 9109,
+                       service: Optional[QueryService] = None) -> Optional[ThreadingHTTPServer]:
+    """
+    在后台线程中启动查询接口，启动失败时只记录日志
+    """
+    service = QueryService(get_snapshot_cache()) if service is None else service
+    try:
+        server = ThreadingHTTPServer((host, port), make_handler(service))
+    except OSError as e:
+        logging.error(f"启动查询接口失败: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="query-server", daemon=True).start()
+    logging.info(f"Query API available at http://{host}:{port}/balance and /today")
+    return server
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_snapshot_cache() -> SnapshotCache:
+    """
+    获取进程内共享的快照缓存，TTL 来自配置 [api] ttl
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            from config import config
+
+            _cache = SnapshotCache(ttl=config.get("api", "ttl", 60))
+        return _cache
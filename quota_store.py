@@ -0,0 +1,207 @@
+"""
+令牌额度快照的本地时序存储（SQLite），用于按小时/天/月查询用量
+"""
+
+import argparse
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+BUCKET_FORMATS = {
+    "hour": "%Y-%m-%d %H:00",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+
+
+class QuotaStore:
+    """
+    每次定时任务查询到的额度写入一条快照。
+
+    用量按相邻快照 used_quota 的差值累加，充值不会影响统计；
+    (account, key_id, ts) 上有索引，单个令牌任意时间范围的查询只扫描该范围内的快照。
+    """
+
+    def __init__(self, path: str = "quota.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS quota_snapshot (
+                ts INTEGER NOT NULL,
+                account TEXT NOT NULL,
+                key_id TEXT NOT NULL,
+                token_name TEXT,
+                remain_quota INTEGER,
+                used_quota INTEGER,
+                unlimited_quota INTEGER,
+                today_request_count INTEGER,
+                today_cost REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_quota_snapshot_token_ts ON quota_snapshot (account, key_id, ts)"
+        )
+        self._conn.commit()
+
+    def record(self, account: str, key_id: str, token_name: str, remain_quota: int, used_quota: int,
+               unlimited_quota: bool = False, today_request_count: Optional[int] = None,
+               today_cost: Optional[float] = None, ts: Optional[int] = None) -> None:
+        """
+        写入一条额度快照
+        """
+        ts = int(time.time()) if ts is None else ts
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO quota_snapshot VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (ts, account, str(key_id), token_name, remain_quota, used_quota, int(bool(unlimited_quota)),
+                 today_request_count, today_cost),
+            )
+            self._conn.commit()
+
+    def latest(self, account: str, key_id: str) -> Optional[dict]:
+        """
+        获取令牌最新的一条快照
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM quota_snapshot WHERE account = ? AND key_id = ? ORDER BY ts DESC LIMIT 1",
+                (account, str(key_id)),
+            )
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, row)) if row else None
+
+    def snapshots(self, account: str, key_id: str, since: int, until: Optional[int] = None) -> list[tuple[int, int, int]]:
+        """
+        获取时间范围内的快照
+
+        Returns:
+            [(ts, remain_quota, used_quota), ...]，按时间正序
+        """
+        until = int(time.time()) if until is None else until
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ts, remain_quota, used_quota FROM quota_snapshot "
+                "WHERE account = ? AND key_id = ? AND ts >= ? AND ts <= ? ORDER BY ts",
+                (account, str(key_id), since, until),
+            ).fetchall()
+
+    def usage(self, account: str, key_id: str, by: str = "day", since: Optional[int] = None,
+              until: Optional[int] = None) -> list[tuple[str, int, int]]:
+        """
+        按小时/天/月统计令牌用量
+
+        Args:
+            account: 账号名称
+            key_id: 令牌 id
+            by: hour / day / month
+            since: 开始时间戳，默认不限
+            until: 结束时间戳，默认为现在
+
+        Returns:
+            [(时间段, 消耗的 quota, 快照数), ...]
+        """
+        bucket_format = BUCKET_FORMATS[by]
+        since = 0 if since is None else since
+        until = int(time.time()) if until is None else until
+        # 取 since 之前的最后一条快照作为起点，使第一个时间段的用量也能计算差值
+        sql = """
+            SELECT strftime(?, ts, 'unixepoch', 'localtime') AS bucket,
+                   SUM(CASE WHEN prev_used IS NOT NULL AND used_quota > prev_used
+                            THEN used_quota - prev_used ELSE 0 END) AS used,
+                   COUNT(*) AS samples
+            FROM (
+                SELECT ts, used_quota, LAG(used_quota) OVER (ORDER BY ts) AS prev_used
+                FROM quota_snapshot
+                WHERE account = ? AND key_id = ? AND ts <= ? AND ts >= COALESCE(
+                    (SELECT MAX(ts) FROM quota_snapshot WHERE account = ? AND key_id = ? AND ts < ?), ?)
+            )
+            WHERE ts >= ?
+            GROUP BY bucket
+            ORDER BY bucket
+        """
+        with self._lock:
+            return self._conn.execute(
+                sql,
+                (bucket_format, account, str(key_id), until, account, str(key_id), since, since, since),
+            ).fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_quota_store() -> Optional[QuotaStore]:
+    """
+    获取进程内共享的存储，配置 [store] enabled = false 时返回 None
+    """
+    global _store
+    from config import config
+
+    if not config.get("store", "enabled", True):
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = QuotaStore(config.get("store", "path", "quota.db"))
+        return _store
+
+
+def _parse_date(value: str) -> int:
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%Y-%m"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"无法解析的时间: {value}")
+
+
+def main(argv=None):
+    from config import config
+
+    parser = argparse.ArgumentParser(description="查询本地保存的令牌额度快照")
+    parser.add_argument("--db", default=config.get("store", "path", "quota.db"), help="数据库路径")
+    parser.add_argument("--account", default=config.get("turboai", "name", "default"), help="账号名称")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    usage_parser = subparsers.add_parser("usage", help="按时间段统计用量")
+    usage_parser.add_argument("key_id", help="令牌 id")
+    usage_parser.add_argument("--by", choices=BUCKET_FORMATS.keys(), default="day")
+    usage_parser.add_argument("--since", type=_parse_date, help="开始时间，如 2024-07-01")
+    usage_parser.add_argument("--until", type=_parse_date, help="结束时间，默认为现在")
+
+    latest_parser = subparsers.add_parser("latest", help="最新快照")
+    latest_parser.add_argument("key_id", help="令牌 id")
+
+    args = parser.parse_args(argv)
+    units = config.get("turboai", "units", 500000)
+    currency = config.get("turboai", "currency", "¥")
+    store = QuotaStore(args.db)
+    started = time.perf_counter()
+    if args.command == "usage":
+        for bucket, used, samples in store.usage(args.account, args.key_id, args.by, args.since, args.until):
+            print(f"{bucket}\t{currency}{used / units:.3f}\t{samples}")
+    else:
+        snapshot = store.latest(args.account, args.key_id)
+        if snapshot is None:
+            print("没有快照")
+        else:
+            snapshot["time"] = datetime.fromtimestamp(snapshot["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+            for key, value in snapshot.items():
+                print(f"{key}: {value}")
+    print(f"查询耗时 {(time.perf_counter() - started) * 1000:.2f}ms", file=sys.stderr)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+登录会话 cookie 的本地持久化，进程重启后可直接复用会话而无需重新登录
+"""
+
+import threading
+
+from json_state import load_json, save_json
+
+_file_lock = threading.Lock()
+
+
+def load_cookies(filename: str, key: str) -> dict:
+    """
+    加载指定账号的 cookie
+
+    Args:
+        filename: cookie 文件路径
+        key: 账号键，一般为 host + 用户名
+
+    Returns:
+        cookie 字典，不存在时返回空字典
+    """
+    with _file_lock:
+        return load_json(filename, "会话 cookie").get(key, {})
+
+
+def save_cookies(filename: str, key: str, cookies: dict) -> None:
+    """
+    保存指定账号的 cookie，文件权限设置为仅当前用户可读写
+    """
+    with _file_lock:
+        all_data = load_json(filename, "会话 cookie")
+        all_data[key] = cookies
+        save_json(filename, all_data, "会话 cookie", mode=0o600)
@@ -3,6 +3,7 @@ import time
 import unittest
 
 from aigc_api import AigcApi
+from log_cursor import LogCursor
 from main import job_aigc
 
 
@@ -28,6 +29,35 @@ class TestAigcApi(unittest.TestCase):
         print(json.dumps(dashboard_data, ensure_ascii=False, indent=4))
         self.assertIsNotNone(dashboard_data)
 
+    def test_iter_logs(self):
+        logs = list(self.aigc_api.iter_logs(1721491200, 1721577600))
+        print(json.dumps(logs[:3], ensure_ascii=False, indent=4))
+        self.assertIsInstance(logs, list)
+
+
+class TestLogCursor(unittest.TestCase):
+    @staticmethod
+    def entry(log_id, created_at):
+        return {"id": log_id, "created_at": created_at, "prompt_tokens": 1, "completion_tokens": 1, "quota": 1}
+
+    def test_collect_new_same_second(self):
+        cursor = LogCursor("test")
+        cursor.add(self.entry(1, 100))
+        cursor.add(self.entry(2, 100))
+        # 同一秒内的日志顺序不固定，已统计的 id 2 之后的 id 3 也要统计
+        pages = [[self.entry(4, 101), self.entry(2, 100)], [self.entry(3, 100), self.entry(1, 100)]]
+        new_entries, page_count = cursor.collect_new(iter(pages))
+        self.assertEqual([entry["id"] for entry in new_entries], [4, 3])
+        self.assertEqual(page_count, 2)
+
+    def test_collect_new_stops_before_watermark(self):
+        cursor = LogCursor("test")
+        cursor.add(self.entry(1, 100))
+        pages = [[self.entry(2, 101), self.entry(1, 100), self.entry(0, 99)], [self.entry(-1, 98)]]
+        new_entries, page_count = cursor.collect_new(iter(pages))
+        self.assertEqual([entry["id"] for entry in new_entries], [2])
+        self.assertEqual(page_count, 1)
+
 
 class TestMain(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,132 @@
+"""
+今日统计的数据来源选择
+
+/api/user/dashboard 一次请求即可得到今天的请求数和 Token，但没有消费金额，且统计的是整个账号；
+日志分页可以得到按令牌的全部统计，但请求数与当天日志量成正比。
+
+- log: 只使用日志分页（默认，与之前的行为一致）
+- dashboard: 只使用仪表板，不统计消费
+- hybrid: 请求数和 Token 来自仪表板，消费来自增量日志统计。仪表板请求数与上次同步时一致，
+  或距上次同步不超过 cost_max_age 秒时沿用上次的消费，不再分页拉取日志
+"""
+
+import logging
+import threading
+import time
+from typing import Optional
+
+from aigc_api import get_start_of_day_timestamp
+from log_stats import ModelBreakdown
+from metrics import TODAY_REQUESTS
+
+SOURCES = ("log", "dashboard", "hybrid")
+
+
+class TodayStatsProvider:
+    """
+    Args:
+        source: 默认的数据来源，账号配置 today_source 可覆盖
+        cost_max_age: hybrid 模式下消费统计的最长沿用时间（秒）
+    """
+
+    def __init__(self, source: str = "log", cost_max_age: int = 300):
+        if source not in SOURCES:
+            raise ValueError(f"不支持的今日统计来源: {source}")
+        self.source = source
+        self.cost_max_age = cost_max_age
+        # 令牌键 -> 上次日志同步的结果
+        self._synced = {}
+        self._lock = threading.Lock()
+
+    def source_for(self, account: dict) -> str:
+        """
+        账号实际使用的来源。仪表板按账号统计，账号监控多个令牌时无法区分，改用日志
+        """
+        source = account.get("today_source", self.source)
+        if source not in SOURCES:
+            logging.warning(f"不支持的今日统计来源 {source}，使用 {self.source}")
+            source = self.source
+        if source != "log" and len(account.get("key_ids", [])) > 1:
+            return "log"
+        return source
+
+    def fetch(self, aigc_api, key_id, token_name: str, breakdown: Optional[ModelBreakdown] = None,
+              now: Optional[float] = None, deadline: Optional[float] = None) -> dict:
+        """
+        获取今日统计
+
+        Args:
+            deadline: 截止时间（time.monotonic()），到达后停止拉取日志，结果标记为 partial
+
+        Returns:
+            {"request_count", "cost", "total_tokens", "source", "requests", "cost_at", "partial"}，
+            cost 为 None 表示未统计消费，cost_at 为消费统计的时间，requests 为本次消耗的上游请求数，
+            partial 表示日志未拉取完，请求数和消费只包含已拉取的部分
+        """
+        now = time.time() if now is None else now
+        source = self.source_for(aigc_api.turboai)
+        if source == "log":
+            usage = {"pages": 0}
+            request_count, cost, total_tokens = aigc_api.get_dashboard_with_log(
+                key_id=key_id, token_name=token_name, breakdown=breakdown, usage=usage, deadline=deadline
+            )
+            return self._result(request_count, cost, total_tokens, "log", usage["pages"], now,
+                                usage.get("partial", False))
+
+        request_count, _, tokens = aigc_api.get_dashboard()
+        _, _, total_tokens = aigc_api.format_dashboard(request_count, tokens, 0, 0)
+        if source == "dashboard":
+            return self._result(request_count, None, total_tokens, "dashboard", 1, None)
+
+        key = f"{aigc_api.turboai.get('name')}/{key_id}"
+        day_start = get_start_of_day_timestamp()
+        with self._lock:
+            synced = self._synced.get(key)
+        if (synced is not None and synced["day_start"] == day_start
+                and (synced["request_count"] == request_count or now - synced["synced_at"] < self.cost_max_age)):
+            if breakdown is not None:
+                breakdown.merge(synced["models"])
+            return self._result(request_count, synced["cost"], total_tokens, "dashboard+cached",
+                                1, synced["synced_at"])
+
+        models = ModelBreakdown(breakdown.by_channel if breakdown is not None else False)
+        usage = {"pages": 0}
+        _, cost, _ = aigc_api.get_dashboard_with_log(key_id=key_id, token_name=token_name, breakdown=models,
+                                                     incremental=True, usage=usage, deadline=deadline)
+        partial = usage.get("partial", False)
+        if not partial:
+            # 未拉取完的消费不能沿用
+            with self._lock:
+                self._synced[key] = {"day_start": day_start, "request_count": request_count, "cost": cost,
+                                     "synced_at": now, "models": models}
+        if breakdown is not None:
+            breakdown.merge(models)
+        return self._result(request_count, cost, total_tokens, "dashboard+log", 1 + usage["pages"], now, partial)
+
+    @staticmethod
+    def _result(request_count, cost, total_tokens, source: str, requests: int, cost_at,
+                partial: bool = False) -> dict:
+        TODAY_REQUESTS.inc(requests, source=source)
+        logging.debug(f"今日统计来源 {source}，请求 {requests} 次")
+        return {"request_count": request_count, "cost": cost, "total_tokens": total_tokens,
+                "source": source, "requests": requests, "cost_at": cost_at, "partial": partial}
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_today_stats_provider() -> TodayStatsProvider:
+    """
+    获取进程内共享的今日统计来源，参数来自配置 [report] today_source、today_cost_max_age
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            from config import config
+
+            _provider = TodayStatsProvider(
+                source=config.get("report", "today_source", "log"),
+                cost_max_age=config.get("report", "today_cost_max_age", 300),
+            )
+        return _provider
@@ -0,0 +1,339 @@
+"""
+分片运行：多个进程（可以分布在多台主机上）通过共享的 SQLite 租约表分担令牌轮询。
+
+每个令牌按 rendezvous 哈希分配给存活的 worker，worker 持有租约期间定期续约；
+worker 停止心跳后租约过期，令牌由哈希到的下一个 worker 接管。轮询前按 polled_at 原子认领，
+同一令牌在每个间隔内只被一个 worker 查询一次。
+
+    python worker.py --processes 4 --name host-a
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+class LeaseTable:
+    """
+    令牌租约和 worker 心跳，多个进程共用同一个 SQLite 文件
+
+    Args:
+        path: 数据库文件路径，多台主机时需放在共享存储上
+        lease_ttl: 租约和心跳的有效期（秒）
+    """
+
+    def __init__(self, path: str = "leases.db", lease_ttl: float = 30):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        # WAL 依赖共享内存，不能用于网络文件系统；多台主机共用租约表时需使用回滚日志，依靠文件锁保证原子认领
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS worker_heartbeat (worker TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS token_lease (
+                token TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL NOT NULL DEFAULT 0,
+                polled_at REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # 通知策略的状态与租约放在一起，令牌迁移到其他 worker 后沿用上次通知的状态
+        self._conn.execute("CREATE TABLE IF NOT EXISTS notify_state (token TEXT PRIMARY KEY, state TEXT NOT NULL)")
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def heartbeat(self, worker: str, now: Optional[float] = None) -> list[str]:
+        """
+        更新心跳
+
+        Returns:
+            存活的 worker 列表（包括自己）
+        """
+        now = time.time() if now is None else now
+        self._execute("INSERT OR REPLACE INTO worker_heartbeat VALUES (?, ?)", (worker, now))
+        # 长时间没有心跳的 worker 不再保留
+        self._execute("DELETE FROM worker_heartbeat WHERE heartbeat_at < ?", (now - self.lease_ttl * 10,))
+        rows = self._execute(
+            "SELECT worker FROM worker_heartbeat WHERE heartbeat_at >= ? ORDER BY worker", (now - self.lease_ttl,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def sync_tokens(self, tokens) -> None:
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO token_lease (token) VALUES (?)", [(t,) for t in tokens])
+
+    def acquire(self, token: str, worker: str, now: Optional[float] = None) -> bool:
+        """
+        获取或续约租约，其他 worker 持有未过期的租约时失败
+        """
+        now = time.time() if now is None else now
+        cursor = self._execute(
+            "UPDATE token_lease SET owner = ?, expires_at = ? "
+            "WHERE token = ? AND (owner = ? OR owner IS NULL OR expires_at < ?)",
+            (worker, now + self.lease_ttl, token, worker, now),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, token: str, worker: str) -> None:
+        self._execute(
+            "UPDATE token_lease SET owner = NULL, expires_at = 0 WHERE token = ? AND owner = ?", (token, worker)
+        )
+
+    def claim_poll(self, token: str, worker: str, interval: float, now: Optional[float] = None) -> bool:
+        """
+        认领本次轮询：持有租约且距上次轮询（无论由哪个 worker 执行）已超过 interval 时成功
+        """
+        now = time.time() if now is None else now
+        cursor = self._execute(
+            "UPDATE token_lease SET polled_at = ? "
+            "WHERE token = ? AND owner = ? AND expires_at >= ? AND polled_at <= ?",
+            (now, token, worker, now, now - interval),
+        )
+        return cursor.rowcount == 1
+
+    def get_notify_state(self, token: str) -> Optional[dict]:
+        row = self._execute("SELECT state FROM notify_state WHERE token = ?", (token,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_notify_state(self, token: str, state: dict) -> None:
+        self._execute("INSERT OR REPLACE INTO notify_state VALUES (?, ?)", (token, json.dumps(state)))
+
+    def stop(self, worker: str) -> None:
+        """
+        正常退出时释放全部租约并删除心跳，其他 worker 无需等待租约过期
+        """
+        self._execute("UPDATE token_lease SET owner = NULL, expires_at = 0 WHERE owner = ?", (worker,))
+        self._execute("DELETE FROM worker_heartbeat WHERE worker = ?", (worker,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SharedNotifyState:
+    """
+    通知策略使用的状态映射，读写租约表中的 notify_state，所有 worker 共用
+    """
+
+    def __init__(self, leases: LeaseTable):
+        self.leases = leases
+
+    def get(self, token: str, default=None):
+        state = self.leases.get_notify_state(token)
+        return default if state is None else state
+
+    def __setitem__(self, token: str, state: dict) -> None:
+        self.leases.set_notify_state(token, state)
+
+
+def rendezvous_owner(token: str, workers: list[str]) -> Optional[str]:
+    """
+    rendezvous 哈希：worker 增减时只有归属于该 worker 的令牌会迁移
+    """
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: hashlib.sha1(f"{worker}|{token}".encode("utf-8")).digest())
+
+
+def worker_path(path: str, worker: str) -> str:
+    """
+    进程本地的状态文件路径，如 log_cursor.json -> log_cursor.host-a-0.json
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker}{ext}"
+
+
+class ShardWorker:
+    """
+    Args:
+        name: worker 名称，在所有主机和进程中唯一，重启后保持不变可沿用本地的状态文件
+        leases: 租约表
+        interval: 每个令牌的轮询间隔（秒）
+        tick: 心跳和检查到期令牌的间隔（秒），应明显小于租约有效期
+    """
+
+    def __init__(self, name: str, leases: LeaseTable, interval: float = 60, tick: float = 5):
+        self.name = name
+        self.leases = leases
+        self.interval = interval
+        self.tick = tick
+        self.owned = []
+        self._stopped = threading.Event()
+
+    def accounts(self) -> dict:
+        """
+        令牌键到 (账号, 令牌 id) 的映射。日志游标和 cookie 等 JSON 状态文件按 worker 区分，避免多进程同时写入；
+        通知策略的状态需要随令牌迁移，保存在共享的租约表中
+        """
+        from config import config
+
+        tokens = {}
+        for account in config.get_accounts():
+            account = dict(
+                account,
+                log_cursor_path=worker_path(account.get("log_cursor_path", "log_cursor.json"), self.name),
+                session_cookie_path=worker_path(
+                    account.get("session_cookie_path", "session_cookies.json"), self.name
+                ),
+            )
+            for key_id in account.get("key_ids", []):
+                tokens[f"{account.get('name')}/{key_id}"] = (account, key_id)
+        return tokens
+
+    def rebalance(self, tokens, now: Optional[float] = None) -> list[str]:
+        """
+        心跳并按存活的 worker 重新分配租约
+
+        Returns:
+            当前持有租约的令牌
+        """
+        live = self.leases.heartbeat(self.name, now)
+        self.leases.sync_tokens(tokens)
+        owned = []
+        for token in tokens:
+            if rendezvous_owner(token, live) == self.name:
+                if self.leases.acquire(token, self.name, now):
+                    owned.append(token)
+            else:
+                self.leases.release(token, self.name)
+        self.owned = owned
+        return owned
+
+    def _heartbeat_loop(self, tokens) -> None:
+        # 轮询耗时较长时心跳也不中断，避免租约被误判过期
+        while not self._stopped.wait(self.tick):
+            try:
+                self.rebalance(tokens)
+            except Exception as e:
+                logging.error(f"[{self.name}] 续约失败, msg: {e}")
+
+    def poll(self, tokens: dict, due: list[str]) -> None:
+        import main
+        from aigc_api import session_manager
+        from config import config
+        from notify_policy import get_notification_policy
+
+        bot = main.create_bot()
+        policy = get_notification_policy(SharedNotifyState(self.leases))
+        apis = {}
+        for token in due:
+            account, _ = tokens[token]
+            if account.get("name") not in apis:
+                apis[account.get("name")] = session_manager.get(account)
+        max_workers = config.get("turboai", "max_workers", 8)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            logins = dict(zip(apis, executor.map(lambda api: api.ensure_login(), apis.values())))
+            futures = []
+            for name, login in logins.items():
+                if not login:
+                    bot.send_text(f"UniAPI登录失败({name})")
+            for token in due:
+                account, key_id = tokens[token]
+                if logins.get(account.get("name")):
+                    futures.append(executor.submit(main.build_token_report, apis[account.get("name")], key_id,
+                                                   policy))
+        reports = []
+        for future in futures:
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                logging.error(f"[{self.name}] 查询令牌失败, msg: {e}")
+        main.dispatch_reports(bot, reports, policy)
+
+    def run_once(self, tokens: dict) -> list[str]:
+        """
+        认领并轮询到期的令牌
+
+        Returns:
+            本次轮询的令牌
+        """
+        import main
+
+        if not self.owned or not main.should_run():
+            return []
+        due = [token for token in self.owned if self.leases.claim_poll(token, self.name, self.interval)]
+        if due:
+            logging.info(f"[{self.name}] 轮询 {len(due)}/{len(tokens)} 个令牌")
+            self.poll(tokens, due)
+        return due
+
+    def run_forever(self) -> None:
+        tokens = self.accounts()
+        self.rebalance(tokens)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(list(tokens),),
+                                     name=f"{self.name}-heartbeat", daemon=True)
+        heartbeat.start()
+        logging.info(f"[{self.name}] worker started, {len(self.owned)}/{len(tokens)} tokens")
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.run_once(tokens)
+                except Exception as e:
+                    logging.error(f"[{self.name}] {e}")
+                self._stopped.wait(self.tick)
+        finally:
+            self._stopped.set()
+            heartbeat.join()
+            self.leases.stop(self.name)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def run_worker(name: str) -> None:
+    import main
+    from config import config
+    from notifier import get_notifier
+
+    main.setup_logging()
+    # 启动后的第一批轮询已认领 polled_at，不能像定时任务那样跳过首次通知
+    main.first_run = False
+    leases = LeaseTable(config.get("worker", "lease_path", "leases.db"), config.get("worker", "lease_ttl", 30))
+    worker = ShardWorker(name, leases, config.get("worker", "interval", 60), config.get("worker", "tick", 5))
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        leases.close()
+        get_notifier().flush(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分片运行 turboai-notify worker")
+    parser.add_argument("--name", default=socket.gethostname(), help="worker 名称前缀，每台主机唯一")
+    parser.add_argument("--processes", type=int, default=None, help="进程数，默认读取配置 [worker] processes")
+    args = parser.parse_args()
+    if args.processes is None:
+        from config import config
+
+        args.processes = config.get("worker", "processes", 1)
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(f"{args.name}-{index}",), name=f"{args.name}-{index}")
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()